@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 class Config(object):
@@ -8,15 +9,105 @@ class Config(object):
     """
     DEBUG = False
     SECRET_KEY = os.getenv('SECRET')
-    MAIL_SERVER = 'smtp.gmail.com'
-    MAIL_PORT = 465
+    MAIL_SERVER = os.getenv('MAIL_SERVER', 'smtp.gmail.com')
+    MAIL_PORT = int(os.getenv('MAIL_PORT', 465))
     MAIL_USE_TLS = False
-    MAIL_USE_SSL = True
+    MAIL_USE_SSL = os.getenv('MAIL_USE_SSL', 'true').lower() == 'true'
     MAIL_USERNAME = os.getenv('GMAIL_MAIL')
     MAIL_PASSWORD = os.getenv('GMAIL_PASSWORD')
     MAIL_SUPPRESS_SEND = True
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # largest page a list endpoint serves
+    MAX_PAGE_LIMIT = 50
+    # least pg_trgm similarity for ?match=fuzzy business search
+    TRIGRAM_SIMILARITY_THRESHOLD = 0.3
+    # per request SQL accounting, see versions/instrumentation.py
+    QUERY_STATS_HEADERS = True
+    QUERY_REPEAT_THRESHOLD = 5
+    # /metrics, answered to requests sending METRICS_TOKEN as
+    # X-Metrics-Token, or to anyone without a token when public
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    METRICS_PUBLIC = True
+    # worker processes of the web process, gunicorn reads it too
+    WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 1))
+    # cached reads of businesses and their reviews, see
+    # versions/responsecache.py
+    RESPONSE_CACHE_ENABLED = os.getenv(
+        'RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+    RESPONSE_CACHE_STORAGE = os.getenv('RESPONSE_CACHE_STORAGE', 'memory')
+    RESPONSE_CACHE_SIZE = 1000
+    RESPONSE_CACHE_TTL = 60
+    # Cache-Control max-age of conditional GETs, clients and the CDN
+    # revalidate with the ETag once it passes
+    HTTP_CACHE_MAX_AGE = 0
+    # business name suggestions, rebuilt after this many seconds
+    SUGGEST_INDEX_MAX_AGE = 300
+    SUGGEST_LIMIT = 10
+    # reviews of a business within this many seconds share one unread
+    # notification, 0 keeps one notification per review
+    NOTIFICATION_COALESCE_WINDOW = int(
+        os.getenv('NOTIFICATION_COALESCE_WINDOW', 0))
+    # actors named on a coalesced notification
+    NOTIFICATION_ACTORS_KEPT = 3
+    # monthly notifications partitions, see versions/partitions.py
+    NOTIFICATION_PARTITIONS_AHEAD = 3
+    NOTIFICATION_RETENTION_DAYS = 180
+    NOTIFICATION_ARCHIVE_DIR = os.getenv(
+        'NOTIFICATION_ARCHIVE_DIR',
+        os.path.join(tempfile.gettempdir(), 'weconnect-notifications')
+    )
+    # live notifications, see versions/broker.py
+    NOTIFICATION_BROKER = os.getenv('NOTIFICATION_BROKER', 'local')
+    # seconds between keepalive comments of an idle stream
+    SSE_HEARTBEAT = 15
+    # milliseconds a client waits before reconnecting
+    SSE_RETRY = 3000
+    # most missed notifications replayed on reconnect
+    SSE_BACKLOG_LIMIT = 100
+    # open streams per worker, each holds one of its WEB_THREADS threads
+    SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', 8))
+    # email outbox, drained by `flask outbox-worker`
+    OUTBOX_BATCH_SIZE = 50
+    OUTBOX_POLL_INTERVAL = 5
+    OUTBOX_MAX_ATTEMPTS = 5
+    OUTBOX_RETRY_BACKOFF = 30
+    MAIL_POOL_SIZE = 2
+    MAIL_POOL_IDLE_TIMEOUT = 60
+    # auth throttling, (attempts, window in seconds) per key
+    RATELIMIT_ENABLED = True
+    RATELIMIT_STORAGE = os.getenv('RATELIMIT_STORAGE', 'memory')
+    RATELIMIT_PER_IP = (60, 60)
+    # seconds between sweeps of attempts out of every window
+    RATELIMIT_SWEEP_INTERVAL = 60
+    # proxies in front of the app that append to X-Forwarded-For
+    RATELIMIT_TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 0))
+    RATELIMITS = {
+        'login': (10, 300),
+        'forgot-password': (3, 3600),
+        'confirm-reset-password': (5, 3600)
+    }
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
+    # bloom filter of revoked tokens shared by workers on the host
+    REVOCATION_CACHE_PATH = os.getenv(
+        'REVOCATION_CACHE_PATH',
+        os.path.join(tempfile.gettempdir(), 'weconnect-revoked.bloom')
+    )
+    REVOCATION_CACHE_BITS = 2 ** 23
+    REVOCATION_CACHE_HASHES = 7
+    ACCESS_TOKEN_MINUTES = 30
+    REFRESH_TOKEN_DAYS = 30
+    # decoded token claims kept per worker, keyed by token digest
+    TOKEN_CACHE_SIZE = 10000
+    # password hashing pool, see versions/hashing.py
+    PASSWORD_HASH_ROUNDS = 535000
+    HASH_POOL_WORKERS = 2
+    # jobs queued or running at once, on the host with sqlite storage
+    HASH_POOL_MAX_PENDING = 16
+    HASH_POOL_STORAGE = os.getenv(
+        'HASH_POOL_STORAGE', 'sqlite:///' + os.path.join(
+            tempfile.gettempdir(), 'weconnect-hashing.sqlite'))
+    HASH_POOL_TIMEOUT = 10
+    HASH_POOL_RETRY_AFTER = 1
 
 
 class Development(Config):
@@ -29,6 +120,17 @@ class Testing(Config):
     DEBUG = True
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL_TEST')
+    REVOCATION_CACHE_PATH = os.path.join(
+        tempfile.gettempdir(), 'weconnect-revoked-test.bloom')
+    PASSWORD_HASH_ROUNDS = 1000
+    HASH_POOL_WORKERS = 0
+    HASH_POOL_STORAGE = 'memory'
+    RATELIMIT_PER_IP = (1000, 60)
+    RATELIMITS = {
+        'login': (100, 60),
+        'forgot-password': (100, 60),
+        'confirm-reset-password': (100, 60)
+    }
 
 
 class Production(Config):
@@ -36,3 +138,9 @@ class Production(Config):
     DEBUG = False
     TESTING = False
     MAIL_SUPPRESS_SEND = False
+    QUERY_STATS_HEADERS = False
+    METRICS_PUBLIC = False
+    RESPONSE_CACHE_STORAGE = os.getenv('RESPONSE_CACHE_STORAGE', 'postgres')
+    NOTIFICATION_BROKER = os.getenv('NOTIFICATION_BROKER', 'postgres')
+    # the Heroku router
+    RATELIMIT_TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 1))
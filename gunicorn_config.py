@@ -0,0 +1,14 @@
+"""gunicorn settings of the web process
+Workers run WEB_THREADS threads each. A request waiting on the password
+hashing pool or the database only holds its own thread, and the pool can
+fork safely since nothing is monkey patched.
+A notification stream holds a thread for as long as it is open, so each
+worker serves at most SSE_MAX_STREAMS of them, keep it below WEB_THREADS
+to leave threads for the rest of the API.
+workers defaults to WEB_CONCURRENCY, set by Heroku per dyno size
+"""
+import os
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', 8000))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', 16))
@@ -0,0 +1,128 @@
+"""partition notifications by month of created_at
+
+Revision ID: 0d5e9a3c7f21
+Revises: f3b8c1d6e402
+Create Date: 2026-10-19 00:12:08.530917
+
+"""
+import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0d5e9a3c7f21'
+down_revision = 'f3b8c1d6e402'
+branch_labels = None
+depends_on = None
+
+# months created past the current one, later ones come from
+# `flask notification-partitions`
+MONTHS_AHEAD = 3
+
+COLUMNS = """
+    id integer NOT NULL DEFAULT nextval('notifications_id_seq'),
+    recipient_id integer NOT NULL REFERENCES users (id),
+    actor varchar NOT NULL,
+    business_id integer NOT NULL,
+    review_id integer NOT NULL,
+    action varchar NOT NULL,
+    read_at timestamp,
+    created_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    actor_count integer NOT NULL DEFAULT 1,
+    actors varchar[],
+    coalesce_key varchar
+"""
+
+COPIED = ('id, recipient_id, actor, business_id, review_id, action, '
+          'read_at, created_at, actor_count, actors, coalesce_key')
+
+# the partition key, the start of the coalescing window of a notification
+# or its created_at, so created_at itself never has to move
+WINDOW_START = 'window_start timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP'
+
+
+def next_month(month):
+    if month.month == 12:
+        return datetime.date(month.year + 1, 1, 1)
+    return datetime.date(month.year, month.month + 1, 1)
+
+
+def upgrade():
+    # created_at is copied to window_start, it can no longer be missing
+    op.execute(
+        'UPDATE notifications SET created_at = CURRENT_TIMESTAMP '
+        'WHERE created_at IS NULL')
+    op.execute('ALTER TABLE notifications RENAME TO notifications_unpartitioned')
+    op.execute('ALTER INDEX notifications_pkey RENAME TO notifications_unpartitioned_pkey')
+    op.execute("""
+        CREATE TABLE notifications ({}, {},
+            PRIMARY KEY (id, window_start)
+        ) PARTITION BY RANGE (window_start)
+    """.format(COLUMNS, WINDOW_START))
+
+    # a partition for every month holding notifications and the next few
+    oldest = op.get_bind().execute(sa.text(
+        'SELECT min(created_at) FROM notifications_unpartitioned'
+    )).scalar() or datetime.datetime.utcnow()
+    month = datetime.date(oldest.year, oldest.month, 1)
+    today = datetime.date.today()
+    last = datetime.date(today.year, today.month, 1)
+    for _ in range(MONTHS_AHEAD):
+        last = next_month(last)
+    while month <= last:
+        op.execute(
+            "CREATE TABLE notifications_{:04d}_{:02d} PARTITION OF "
+            "notifications FOR VALUES FROM ('{}') TO ('{}')".format(
+                month.year, month.month, month, next_month(month)))
+        month = next_month(month)
+    # catches months nobody created a partition for, inserts never fail
+    op.execute('CREATE TABLE notifications_default PARTITION OF '
+               'notifications DEFAULT')
+
+    op.execute("""
+        INSERT INTO notifications ({0}, window_start)
+        SELECT {0}, created_at FROM notifications_unpartitioned
+    """.format(COPIED))
+    op.execute('ALTER SEQUENCE notifications_id_seq OWNED BY notifications.id')
+    op.drop_table('notifications_unpartitioned')
+
+    op.create_index(
+        'ix_notifications_recipient_id_created_at_id', 'notifications',
+        ['recipient_id', 'created_at', 'id'], unique=False)
+    op.create_index(
+        'ix_notifications_unread_recipient_id_created_at_id', 'notifications',
+        ['recipient_id', 'created_at', 'id'], unique=False,
+        postgresql_where=sa.text('read_at IS NULL'))
+    op.create_index(
+        'ux_notifications_recipient_id_coalesce_key_window_start',
+        'notifications', ['recipient_id', 'coalesce_key', 'window_start'],
+        unique=True, postgresql_where=sa.text('read_at IS NULL'))
+
+
+def downgrade():
+    op.execute('ALTER TABLE notifications RENAME TO notifications_partitioned')
+    op.execute('ALTER INDEX notifications_pkey RENAME TO notifications_partitioned_pkey')
+    op.execute("""
+        CREATE TABLE notifications ({},
+            CONSTRAINT notifications_pkey PRIMARY KEY (id)
+        )
+    """.format(COLUMNS))
+    # the window goes back into the coalesce key, which is unique alone
+    op.execute("""
+        INSERT INTO notifications ({0})
+        SELECT {1} FROM notifications_partitioned
+    """.format(COPIED, COPIED.replace(
+        'coalesce_key', "coalesce_key || ':' || "
+        "CAST(extract(epoch FROM window_start) AS bigint)")))
+    op.execute('ALTER SEQUENCE notifications_id_seq OWNED BY notifications.id')
+    # dropping the parent drops its partitions
+    op.drop_table('notifications_partitioned')
+
+    op.create_index(
+        'ix_notifications_recipient_id_created_at_id', 'notifications',
+        ['recipient_id', 'created_at', 'id'], unique=False)
+    op.create_index(
+        'ux_notifications_recipient_id_coalesce_key', 'notifications',
+        ['recipient_id', 'coalesce_key'], unique=True,
+        postgresql_where=sa.text('read_at IS NULL'))
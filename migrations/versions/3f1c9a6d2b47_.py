@@ -0,0 +1,100 @@
+"""store token digests with expiry on authtokens
+
+Revision ID: 3f1c9a6d2b47
+Revises: 859b56bcdc32
+Create Date: 2026-10-18 10:12:31.204118
+
+"""
+import datetime
+import hashlib
+from alembic import op
+import jwt
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a6d2b47'
+down_revision = '859b56bcdc32'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+authtokens = sa.table(
+    'authtokens',
+    sa.column('id', sa.Integer),
+    sa.column('token', sa.String),
+    sa.column('digest', sa.String),
+    sa.column('expires_at', sa.DateTime)
+)
+
+
+def expiry(token):
+    """exp claim of a stored token, already expired when unreadable"""
+    try:
+        claims = jwt.decode(token, verify=False)
+        return datetime.datetime.utcfromtimestamp(claims['exp'])
+    except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+        return datetime.datetime.utcnow()
+
+
+def upgrade():
+    op.add_column('authtokens', sa.Column('digest', sa.String(64), nullable=True))
+    op.add_column('authtokens', sa.Column('expires_at', sa.DateTime(), nullable=True))
+
+    # backfill in id order, one batch per round trip
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select([authtokens.c.id, authtokens.c.token])
+            .where(authtokens.c.id > last_id)
+            .order_by(authtokens.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        conn.execute(
+            authtokens.update()
+            .where(authtokens.c.id == sa.bindparam('row_id'))
+            .values(
+                digest=sa.bindparam('row_digest'),
+                expires_at=sa.bindparam('row_expires_at')
+            ),
+            [
+                {
+                    'row_id': row.id,
+                    'row_digest': hashlib.sha256(
+                        row.token.encode('UTF-8')).hexdigest(),
+                    'row_expires_at': expiry(row.token)
+                } for row in rows
+            ]
+        )
+        last_id = rows[-1].id
+
+    # identical tokens collapse to one row, a revoked copy wins
+    op.execute(
+        'DELETE FROM authtokens a USING authtokens b '
+        'WHERE a.digest = b.digest AND (a.valid, a.id) > (b.valid, b.id)'
+    )
+
+    op.alter_column('authtokens', 'digest', nullable=False)
+    op.alter_column('authtokens', 'expires_at', nullable=False)
+    op.create_index(
+        op.f('ix_authtokens_digest'), 'authtokens', ['digest'], unique=True)
+    op.create_index(
+        op.f('ix_authtokens_expires_at'), 'authtokens', ['expires_at'],
+        unique=False)
+    op.drop_column('authtokens', 'token')
+
+
+def downgrade():
+    # raw tokens cannot be recovered from their digests
+    op.add_column(
+        'authtokens',
+        sa.Column('token', sa.String(), nullable=False, server_default='')
+    )
+    op.drop_index(op.f('ix_authtokens_expires_at'), table_name='authtokens')
+    op.drop_index(op.f('ix_authtokens_digest'), table_name='authtokens')
+    op.drop_column('authtokens', 'expires_at')
+    op.drop_column('authtokens', 'digest')
@@ -0,0 +1,28 @@
+"""response cache tag versions
+
+Revision ID: 6e2b8d4f1a93
+Revises: 0d5e9a3c7f21
+Create Date: 2026-10-19 09:41:26.308152
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2b8d4f1a93'
+down_revision = '0d5e9a3c7f21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cache_tags',
+    sa.Column('tag', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('tag')
+    )
+
+
+def downgrade():
+    op.drop_table('cache_tags')
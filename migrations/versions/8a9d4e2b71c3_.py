@@ -0,0 +1,27 @@
+"""trigram index on business names
+
+Revision ID: 8a9d4e2b71c3
+Revises: e7a3c5f92d18
+Create Date: 2026-10-18 15:02:11.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a9d4e2b71c3'
+down_revision = 'e7a3c5f92d18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute(
+        'CREATE INDEX ix_businesses_name_trgm ON businesses '
+        'USING gin (lower(name) gin_trgm_ops)')
+
+
+def downgrade():
+    op.drop_index('ix_businesses_name_trgm', table_name='businesses')
@@ -0,0 +1,41 @@
+"""notification event ids
+
+Revision ID: 9c4a1e7b5d28
+Revises: 6e2b8d4f1a93
+Create Date: 2026-10-19 10:27:53.614089
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4a1e7b5d28'
+down_revision = '6e2b8d4f1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE SEQUENCE notification_events_seq')
+    op.add_column('notifications', sa.Column(
+        'event_id', sa.BigInteger(), nullable=True))
+    # streams resuming from a notification id carry on where they were
+    op.execute('UPDATE notifications SET event_id = id')
+    op.execute(
+        "SELECT setval('notification_events_seq', "
+        "(SELECT coalesce(max(id), 0) + 1 FROM notifications), false)")
+    op.execute(
+        "ALTER TABLE notifications ALTER COLUMN event_id "
+        "SET DEFAULT nextval('notification_events_seq')")
+    op.alter_column('notifications', 'event_id', nullable=False)
+    op.create_index(
+        'ix_notifications_recipient_id_event_id', 'notifications',
+        ['recipient_id', 'event_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(
+        'ix_notifications_recipient_id_event_id', table_name='notifications')
+    op.drop_column('notifications', 'event_id')
+    op.execute('DROP SEQUENCE notification_events_seq')
@@ -0,0 +1,36 @@
+"""version column on businesses and reviews
+
+Revision ID: b6f1d2c8e904
+Revises: 8a9d4e2b71c3
+Create Date: 2026-10-18 20:31:54.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6f1d2c8e904'
+down_revision = '8a9d4e2b71c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the server default fills existing rows without rewriting them one
+    # by one
+    op.add_column(
+        'businesses',
+        sa.Column('version', sa.Integer(), server_default='1',
+                  nullable=False)
+    )
+    op.add_column(
+        'reviews',
+        sa.Column('version', sa.Integer(), server_default='1',
+                  nullable=False)
+    )
+
+
+def downgrade():
+    op.drop_column('reviews', 'version')
+    op.drop_column('businesses', 'version')
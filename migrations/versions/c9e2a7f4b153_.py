@@ -0,0 +1,41 @@
+"""notification inbox index and unread counters
+
+Revision ID: c9e2a7f4b153
+Revises: b6f1d2c8e904
+Create Date: 2026-10-18 21:40:12.870341
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9e2a7f4b153'
+down_revision = 'b6f1d2c8e904'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_notifications_recipient_id_created_at_id', 'notifications',
+        ['recipient_id', 'created_at', 'id'], unique=False)
+    op.create_table('notification_counters',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('unread', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.execute("""
+        INSERT INTO notification_counters (user_id, unread)
+        SELECT recipient_id, count(*) FROM notifications
+        WHERE read_at IS NULL
+        GROUP BY recipient_id
+    """)
+
+
+def downgrade():
+    op.drop_table('notification_counters')
+    op.drop_index(
+        'ix_notifications_recipient_id_created_at_id',
+        table_name='notifications')
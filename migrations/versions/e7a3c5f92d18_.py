@@ -0,0 +1,57 @@
+"""full text search vector on businesses
+
+Revision ID: e7a3c5f92d18
+Revises: d41b6e0f8c35
+Create Date: 2026-10-18 13:47:40.392857
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a3c5f92d18'
+down_revision = 'd41b6e0f8c35'
+branch_labels = None
+depends_on = None
+
+SEARCH_VECTOR = """
+    setweight(to_tsvector('pg_catalog.english', coalesce({0}name, '')), 'A') ||
+    setweight(to_tsvector('pg_catalog.english', coalesce({0}category, '')), 'B') ||
+    setweight(to_tsvector('pg_catalog.english', coalesce({0}bio, '')), 'C')
+"""
+
+
+def upgrade():
+    op.add_column(
+        'businesses',
+        sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True)
+    )
+    op.execute("""
+        CREATE FUNCTION businesses_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := {};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """.format(SEARCH_VECTOR.format('NEW.')))
+    op.execute("""
+        CREATE TRIGGER businesses_search_vector_trigger
+        BEFORE INSERT OR UPDATE OF name, category, bio ON businesses
+        FOR EACH ROW EXECUTE PROCEDURE businesses_search_vector_update()
+    """)
+    op.execute(
+        'UPDATE businesses SET search_vector = {}'.format(
+            SEARCH_VECTOR.format('')))
+    op.create_index(
+        'ix_businesses_search_vector', 'businesses', ['search_vector'],
+        unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_businesses_search_vector', table_name='businesses')
+    op.execute(
+        'DROP TRIGGER businesses_search_vector_trigger ON businesses')
+    op.execute('DROP FUNCTION businesses_search_vector_update()')
+    op.drop_column('businesses', 'search_vector')
@@ -0,0 +1,39 @@
+"""coalesced notifications
+
+Revision ID: f3b8c1d6e402
+Revises: c9e2a7f4b153
+Create Date: 2026-10-18 23:05:41.219874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8c1d6e402'
+down_revision = 'c9e2a7f4b153'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('notifications', sa.Column(
+        'actor_count', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('notifications', sa.Column(
+        'actors', postgresql.ARRAY(sa.String()), nullable=True))
+    op.add_column('notifications', sa.Column(
+        'coalesce_key', sa.String(), nullable=True))
+    op.create_index(
+        'ux_notifications_recipient_id_coalesce_key', 'notifications',
+        ['recipient_id', 'coalesce_key'], unique=True,
+        postgresql_where=sa.text('read_at IS NULL'))
+
+
+def downgrade():
+    op.drop_index(
+        'ux_notifications_recipient_id_coalesce_key',
+        table_name='notifications')
+    op.drop_column('notifications', 'coalesce_key')
+    op.drop_column('notifications', 'actors')
+    op.drop_column('notifications', 'actor_count')
@@ -0,0 +1,15 @@
+"""Helpers shared by the test cases"""
+import unittest
+
+
+class BaseTestCase(unittest.TestCase):
+    """TestCase with assertions on the SQL a request sent"""
+
+    def assertQueryBudget(self, response, budget):
+        """Fails when the request behind response sent more than budget
+        statements, as reported in the X-DB-Query-Count header
+        """
+        count = int(response.headers['X-DB-Query-Count'])
+        self.assertLessEqual(
+            count, budget,
+            'sent {} queries, budget is {}'.format(count, budget))
@@ -1,7 +1,21 @@
 import unittest
 import json
-from versions import app
-from versions.v2.models import User, db
+import datetime
+import jwt
+import os
+import smtplib
+import tempfile
+import time
+from concurrent.futures import Future
+from flask_mail import Connection
+from mock import patch
+from versions import app, decoded_tokens, mail, mail_transport, outbox
+from versions import hashing_pool, limiter, revoked_tokens
+from versions.hashing import HashingPool, SQLiteSlots
+from versions.ratelimit import MemoryBackend, SQLiteBackend
+from versions.revocation import RevocationCache
+from versions import token_digest
+from versions.v2.models import User, db, AuthToken, Outbox
 from passlib.hash import sha256_crypt
 
 
@@ -181,6 +195,106 @@ class TestAuth(unittest.TestCase):
         self.assertEqual(new_login.status_code, 200)
         self.assertIn('Login success', str(new_login.data))
 
+    def test_login_token_carries_user_claims(self):
+        """Test token claims describe the user without a lookup"""
+        self.register()
+        token = json.loads(self.login().get_data(as_text=True))['token']
+        claims = jwt.decode(token, app.config['SECRET_KEY'])
+        user = User.query.filter_by(
+            username=self.new_user_info['username']).first()
+        self.assertEqual(claims['id'], user.id)
+        self.assertEqual(claims['username'], user.username)
+        self.assertEqual(claims['activate'], user.activate)
+
+    def test_login_upgrades_password_hash(self):
+        """Test a hash below the configured cost is replaced at login"""
+        self.register()
+        rounds = app.config['PASSWORD_HASH_ROUNDS']
+        app.config['PASSWORD_HASH_ROUNDS'] = rounds + 1000
+        try:
+            new_login = self.login()
+        finally:
+            app.config['PASSWORD_HASH_ROUNDS'] = rounds
+        self.assertEqual(new_login.status_code, 200)
+
+        password = User.query.filter_by(
+            username=self.new_user_info['username']).first().password
+        self.assertIn('rounds={}$'.format(rounds + 1000), password)
+        self.assertTrue(sha256_crypt.verify(
+            self.new_user_login['password'], password))
+
+    def test_login_when_hashing_pool_is_full(self):
+        """Test login is turned away with 503 when hashing is saturated"""
+        self.register()
+        max_pending = app.config['HASH_POOL_MAX_PENDING']
+        app.config['HASH_POOL_MAX_PENDING'] = 0
+        try:
+            response = self.login()
+        finally:
+            app.config['HASH_POOL_MAX_PENDING'] = max_pending
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            response.headers['Retry-After'],
+            str(app.config['HASH_POOL_RETRY_AFTER']))
+
+    def test_hashing_queue_is_shared_by_the_workers(self):
+        """Test jobs queued by another worker count against the cap"""
+        self.register()
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        config = dict(
+            (key, app.config[key])
+            for key in ['HASH_POOL_STORAGE', 'HASH_POOL_MAX_PENDING'])
+        app.config.update(
+            HASH_POOL_STORAGE='sqlite:///' + path, HASH_POOL_MAX_PENDING=1)
+        slots = hashing_pool._slots
+        hashing_pool._slots = None
+        try:
+            # a job of another worker on the same host
+            other = HashingPool(app)
+            slot = other.slots.acquire(1, 10, time.time())
+            busy = self.login()
+            other.slots.release(slot)
+            response = self.login()
+        finally:
+            hashing_pool._slots = slots
+            app.config.update(config)
+            os.remove(path)
+        self.assertEqual(busy.status_code, 503)
+        self.assertEqual(response.status_code, 200)
+
+    def test_hashing_slots_left_by_a_dead_worker_expire(self):
+        """Test a slot older than the timeout no longer counts"""
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        try:
+            first, second = SQLiteSlots(path), SQLiteSlots(path)
+            self.assertIsNotNone(first.acquire(1, 10, 100.0))
+            self.assertIsNone(second.acquire(1, 10, 105.0))
+            self.assertIsNotNone(second.acquire(1, 10, 110.5))
+            self.assertEqual(first.count(), 1)
+        finally:
+            os.remove(path)
+
+    def test_login_when_hashing_times_out(self):
+        """Test a hashing job running past the timeout is answered with 503"""
+        self.register()
+        config = dict(
+            (key, app.config[key])
+            for key in ['HASH_POOL_WORKERS', 'HASH_POOL_TIMEOUT'])
+        app.config.update(HASH_POOL_WORKERS=1, HASH_POOL_TIMEOUT=0.01)
+        try:
+            # a job that never finishes
+            with patch.object(hashing_pool, '_pool') as pool:
+                pool.return_value.submit.return_value = Future()
+                response = self.login()
+        finally:
+            app.config.update(config)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            response.headers['Retry-After'],
+            str(app.config['HASH_POOL_RETRY_AFTER']))
+
     def test_unsuccesfull_login(self):
         """Test unsuccesfull login
         1. test validation
@@ -227,6 +341,87 @@ class TestAuth(unittest.TestCase):
             'Cannot Login wrong password',
             str(new_login_3.data))
 
+    def test_login_is_throttled_per_username(self):
+        """Test attempts over the limit are refused before hashing"""
+        self.register()
+        limits = app.config['RATELIMITS']
+        app.config['RATELIMITS'] = dict(limits, login=(2, 60))
+        limiter.backend.reset()
+        try:
+            self.login()
+            self.login()
+            completed = hashing_pool.completed
+            response = self.login()
+        finally:
+            app.config['RATELIMITS'] = limits
+            limiter.backend.reset()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(hashing_pool.completed, completed)
+
+    def test_login_is_throttled_per_forwarded_client(self):
+        """Test clients behind the proxy are limited apart, by the address
+        the proxy appended and not one they wrote themselves
+        """
+        self.register()
+        config = dict(
+            (key, app.config[key])
+            for key in ['RATELIMIT_PER_IP', 'RATELIMIT_TRUSTED_PROXIES'])
+        app.config.update(RATELIMIT_PER_IP=(2, 60), RATELIMIT_TRUSTED_PROXIES=1)
+        limiter.backend.reset()
+
+        def login(forwarded_for):
+            return self.app_client.post(
+                '/api/v2/auth/login',
+                data=json.dumps(self.new_user_login),
+                content_type='application/json',
+                headers={'X-Forwarded-For': forwarded_for},
+                environ_base={'REMOTE_ADDR': '10.0.0.1'})
+
+        try:
+            login('41.90.1.1')
+            login('1.2.3.4, 41.90.1.1')
+            spoofed = login('5.6.7.8, 41.90.1.1')
+            other = login('41.90.2.2')
+        finally:
+            app.config.update(config)
+            limiter.backend.reset()
+        self.assertEqual(spoofed.status_code, 429)
+        self.assertEqual(other.status_code, 200)
+
+    def test_sqlite_rate_limit_backend_is_shared(self):
+        """Test two backends on one file see each other's attempts"""
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        try:
+            first, second = SQLiteBackend(path), SQLiteBackend(path)
+            self.assertEqual(first.hit('login:victor', 2, 60, 100.0), 0)
+            self.assertEqual(second.hit('login:victor', 2, 60, 101.0), 0)
+            self.assertEqual(first.hit('login:victor', 2, 60, 102.0), 58.0)
+            # the oldest attempt has left the window
+            self.assertEqual(second.hit('login:victor', 2, 60, 160.5), 0)
+        finally:
+            os.remove(path)
+
+    def test_rate_limit_backends_forget_idle_keys(self):
+        """Test a sweep drops every key out of the window, not just the
+        ones hit again
+        """
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        try:
+            memory, sqlite = MemoryBackend(), SQLiteBackend(path)
+            for backend in memory, sqlite:
+                for name in ['anna', 'bob', 'carol']:
+                    backend.hit('login:' + name, 10, 60, 100.0)
+                backend.hit('login:dave', 10, 60, 150.0)
+                backend.sweep(60, 200.0)
+            self.assertEqual(list(memory._attempts), ['login:dave'])
+            self.assertEqual(sqlite._connection().execute(
+                'SELECT key FROM attempts').fetchall(), [('login:dave',)])
+        finally:
+            os.remove(path)
+
     def test_reset_password(self):
         """Test reset password"""
         self.register()
@@ -312,6 +507,139 @@ class TestAuth(unittest.TestCase):
         output = json.loads(response2.get_data(as_text=True))['warning']
         self.assertEqual(output, 'Login again')
 
+    def test_refresh_token_rotation(self):
+        """Test refresh issues new tokens and rejects a reused one
+        """
+        self.register()
+        refresh_token = json.loads(
+            self.login().get_data(as_text=True))['refresh_token']
+
+        response = self.refresh(refresh_token)
+        self.assertEqual(response.status_code, 200)
+        output = json.loads(response.get_data(as_text=True))
+        self.assertIn('token', output)
+        self.assertNotEqual(output['refresh_token'], refresh_token)
+
+        # reusing the old token revokes the family, successor included
+        response2 = self.refresh(refresh_token)
+        self.assertEqual(response2.status_code, 401)
+        response3 = self.refresh(output['refresh_token'])
+        self.assertEqual(response3.status_code, 401)
+
+    def test_logout_revokes_refresh_tokens(self):
+        """Test logout revokes the refresh tokens of the session
+        """
+        self.register()
+        output = json.loads(self.login().get_data(as_text=True))
+        self.app_client.delete(
+            '/api/v2/auth/logout',
+            headers={
+                "content-type": "application/json",
+                "x-access-token": output['token']
+            }
+        )
+        response = self.refresh(output['refresh_token'])
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('Invalid refresh token', str(response.data))
+
+    def test_logout_updates_revocation_cache(self):
+        """Test logout flags the token in the shared revocation cache
+        """
+        self.register()
+        token = json.loads(self.login().get_data(as_text=True))['token']
+        self.assertFalse(revoked_tokens.might_be_revoked(token_digest(token)))
+
+        self.app_client.delete(
+            '/api/v2/auth/logout',
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token
+            }
+        )
+        self.assertTrue(revoked_tokens.might_be_revoked(token_digest(token)))
+
+        response = self.app_client.get('/metrics')
+        output = json.loads(response.get_data(as_text=True))
+        self.assertGreater(output['revocation_cache']['hits'], 0)
+        self.assertGreater(output['revocation_cache']['misses'], 0)
+
+    def test_revocations_retire_after_two_token_lifetimes(self):
+        """Test a digest stays flagged while its token can be alive and
+        is dropped once the generation after the next begins
+        """
+        handle, path = tempfile.mkstemp(suffix='.bloom')
+        os.close(handle)
+        try:
+            lifetime = 1800
+            first = RevocationCache(path, 2 ** 10, 3, lifetime)
+            second = RevocationCache(path, 2 ** 10, 3, lifetime)
+            digest = token_digest('revoked-token')
+            first.add(digest, now=lifetime * 10 + 1700)
+            # the last moment the token can still be alive
+            self.assertTrue(second.might_be_revoked(
+                digest, now=lifetime * 11 + 1700))
+            self.assertFalse(second.might_be_revoked(
+                digest, now=lifetime * 12))
+            self.assertFalse(first.might_be_revoked(
+                digest, now=lifetime * 12))
+        finally:
+            os.remove(path)
+
+    def test_metrics_need_the_token_when_set(self):
+        """Test /metrics is hidden without the configured token"""
+        app.config['METRICS_TOKEN'] = 'metrics-secret'
+        try:
+            hidden = self.app_client.get('/metrics')
+            shown = self.app_client.get(
+                '/metrics', headers={'X-Metrics-Token': 'metrics-secret'})
+        finally:
+            app.config['METRICS_TOKEN'] = None
+        self.assertEqual(hidden.status_code, 404)
+        self.assertEqual(shown.status_code, 200)
+
+        app.config['METRICS_PUBLIC'] = False
+        try:
+            self.assertEqual(
+                self.app_client.get('/metrics').status_code, 404)
+        finally:
+            app.config['METRICS_PUBLIC'] = True
+
+    def test_decoded_token_cache(self):
+        """Test claims are cached per token and dropped at logout
+        """
+        self.register()
+        token = json.loads(self.login().get_data(as_text=True))['token']
+        headers = {
+            "content-type": "application/json",
+            "x-access-token": token
+        }
+        self.app_client.get('/api/v2/notifications', headers=headers)
+        hits = decoded_tokens.hits
+        self.app_client.get('/api/v2/notifications', headers=headers)
+        self.assertEqual(decoded_tokens.hits, hits + 1)
+        self.assertIsNotNone(decoded_tokens.get(token_digest(token)))
+
+        self.app_client.delete('/api/v2/auth/logout', headers=headers)
+        self.assertIsNone(decoded_tokens.get(token_digest(token)))
+
+        response = self.app_client.get('/metrics')
+        output = json.loads(response.get_data(as_text=True))
+        self.assertIn('hit_rate', output['token_cache'])
+
+    def test_purge_expired_tokens(self):
+        """Test purge removes expired tokens and keeps live ones
+        """
+        now = datetime.datetime.utcnow()
+        AuthToken('expired-token', now - datetime.timedelta(minutes=1)).save()
+        AuthToken('live-token', now + datetime.timedelta(minutes=30)).save()
+
+        self.assertGreaterEqual(AuthToken.purge_expired(batch_size=1), 1)
+        self.assertIsNone(AuthToken.find('expired-token'))
+        live_token = AuthToken.find('live-token')
+        self.assertIsNotNone(live_token)
+        db.session.delete(live_token)
+        db.session.commit()
+
     def test_forgot_password(self):
         """Test when user has forgotten password"""
         self.register()
@@ -324,6 +652,85 @@ class TestAuth(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn('Email has been sent with new password', str(response.data))
 
+    def test_registration_queues_activation_email(self):
+        """Test signup writes the email to the outbox for the worker"""
+        self.register()
+        with app.app_context():
+            queued = Outbox.query.filter_by(
+                recipients=self.new_user_info['email']).first()
+            self.assertEqual(queued.status, 'pending')
+            self.assertEqual(queued.template, 'email.html')
+
+            with mail.record_messages() as outbox_sent:
+                outbox.drain(batch_size=10)
+            self.assertEqual(queued.status, 'sent')
+            self.assertIsNone(queued.context)
+            self.assertEqual(
+                outbox_sent[0].recipients, [self.new_user_info['email']])
+            self.assertIn('Verify Account', outbox_sent[0].subject)
+
+    def test_mail_transport_reuses_connections(self):
+        """Test consecutive batches share a pooled connection"""
+        self.register()
+        with app.app_context():
+            outbox.drain(batch_size=10)
+            reused = mail_transport.connections_reused
+            self.app_client.post(
+                '/api/v2/auth/forgot-password',
+                data=json.dumps({'email': self.new_user_info['email']}),
+                content_type='application/json'
+            )
+            with mail.record_messages() as outbox_sent:
+                outbox.drain(batch_size=10)
+        self.assertEqual(mail_transport.connections_reused, reused + 1)
+        self.assertIn('New Password', outbox_sent[0].html)
+
+    def test_outbox_retries_then_dead_letters(self):
+        """Test failed deliveries back off and end up dead"""
+        self.register()
+        max_attempts = app.config['OUTBOX_MAX_ATTEMPTS']
+        app.config['OUTBOX_MAX_ATTEMPTS'] = 2
+        try:
+            with app.app_context(), patch.object(
+                    Connection, 'send',
+                    side_effect=smtplib.SMTPException('down')):
+                queued = Outbox.query.filter_by(
+                    recipients=self.new_user_info['email']).first()
+                outbox.drain(batch_size=10)
+                self.assertEqual(queued.status, 'pending')
+                self.assertEqual(queued.attempts, 1)
+                self.assertGreater(
+                    queued.next_attempt_at, datetime.datetime.utcnow())
+
+                queued.next_attempt_at = datetime.datetime.utcnow()
+                db.session.commit()
+                outbox.drain(batch_size=10)
+                self.assertEqual(queued.status, 'dead')
+                self.assertEqual(queued.last_error, 'down')
+        finally:
+            app.config['OUTBOX_MAX_ATTEMPTS'] = max_attempts
+
+    def test_outbox_survives_a_message_that_cannot_be_built(self):
+        """Test a bad row is retried like a failed send, the rest delivered"""
+        self.register()
+        with app.app_context():
+            queued = Outbox.query.filter_by(
+                recipients=self.new_user_info['email']).first()
+            db.session.add(Outbox(
+                subject='Broken', recipients=['broken@gmail.com'],
+                template='missing.html',
+                context='{"_base_url": "http://localhost/"}'))
+            db.session.commit()
+            with mail.record_messages() as outbox_sent:
+                self.assertEqual(outbox.drain(batch_size=10), 2)
+            broken = Outbox.query.filter_by(
+                recipients='broken@gmail.com').first()
+            self.assertEqual(queued.status, 'sent')
+            self.assertEqual(len(outbox_sent), 1)
+            self.assertEqual(broken.status, 'pending')
+            self.assertEqual(broken.attempts, 1)
+            self.assertIn('missing.html', broken.last_error)
+
     def test_unsuccessful_forgot_password(self):
         """Test email not found at forgot password"""
         email = {'email': 'vic_mutai@gmail.com'}
@@ -358,7 +765,15 @@ class TestAuth(unittest.TestCase):
             content_type='application/json'
         )
 
+    def refresh(self, refresh_token):
+        return self.app_client.post(
+            '/api/v2/auth/refresh',
+            data=json.dumps({'refresh_token': refresh_token}),
+            content_type='application/json'
+        )
+
     def tearDown(self):
         """Clean-up db"""
+        db.session.query(Outbox).delete()
         db.session.query(User).delete()
         db.session.commit()
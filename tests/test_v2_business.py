@@ -1,10 +1,14 @@
 import unittest
 import json
-from versions import app
+import os
+import tempfile
+from versions import app, business_names, response_cache
+from versions.responsecache import ResponseCache, SQLiteTier, business_tag
 from versions.v2.models import User, db, Business
+from tests.base import BaseTestCase
 
 
-class TestBusinessV2(unittest.TestCase):
+class TestBusinessV2(BaseTestCase):
     def setUp(self):
         app.config.from_object('config.Testing')
         self.app = app.test_client()
@@ -42,6 +46,336 @@ class TestBusinessV2(unittest.TestCase):
         output = json.loads(response.get_data(as_text=True))['businesses']
         self.assertEqual(output[0]['name'], self.new_business_info['name'])
 
+    def test_read_businesses_by_cursor(self):
+        """Test keyset pages follow the next cursor without overlap
+        """
+        self.register_business()
+        token = self.token()
+        for name in ['Bata', 'Tuskys', 'Naivas']:
+            self.app.post(
+                '/api/v2/businesses/',
+                data=json.dumps(dict(self.new_business_info, name=name)),
+                headers={
+                    "content-type": "application/json",
+                    "x-access-token": token})
+
+        first = json.loads(self.app.get(
+            '/api/v2/businesses/?limit=3').get_data(as_text=True))
+        self.assertEqual(len(first['businesses']), 3)
+        self.assertIsNotNone(first['next'])
+
+        second = json.loads(self.app.get(
+            '/api/v2/businesses/?limit=3&cursor={}'.format(first['next'])
+        ).get_data(as_text=True))
+        self.assertIsNone(second['next'])
+        names = [b['name'] for b in first['businesses'] + second['businesses']]
+        self.assertEqual(
+            sorted(names), sorted(['Crown', 'Bata', 'Tuskys', 'Naivas']))
+
+    def test_search_businesses_full_text(self):
+        """Test q searches name and bio, ranked, within the filters
+        """
+        self.register_business()
+        token = self.token()
+        for business in [
+                dict(self.new_business_info, name='Sadolin',
+                     bio='paints and coatings'),
+                dict(self.new_business_info, name='Paint Hub',
+                     bio='decor', location='MSA')]:
+            self.app.post(
+                '/api/v2/businesses/',
+                data=json.dumps(business),
+                headers={
+                    "content-type": "application/json",
+                    "x-access-token": token})
+
+        output = json.loads(self.app.get(
+            '/api/v2/businesses/?q=paint').get_data(as_text=True))
+        names = [b['name'] for b in output['businesses']]
+        # a name match outranks a bio match
+        self.assertEqual(names, ['Paint Hub', 'Sadolin'])
+
+        output = json.loads(self.app.get(
+            '/api/v2/businesses/?q=paint&location=NBO&limit=1'
+        ).get_data(as_text=True))
+        self.assertEqual(
+            [b['name'] for b in output['businesses']], ['Sadolin'])
+        self.assertIsNone(output['next'])
+
+    def test_search_businesses_by_substring(self):
+        """Test match=substring finds q inside names, wildcards literal
+        """
+        self.register_business()
+        token = self.token()
+        for name in ['Crownbet', 'Kencrown', '100% Crow']:
+            self.app.post(
+                '/api/v2/businesses/',
+                data=json.dumps(dict(self.new_business_info, name=name)),
+                headers={
+                    "content-type": "application/json",
+                    "x-access-token": token})
+
+        output = json.loads(self.app.get(
+            '/api/v2/businesses/?q=CROWN&match=substring'
+        ).get_data(as_text=True))
+        self.assertEqual(
+            [b['name'] for b in output['businesses']],
+            ['Kencrown', 'Crownbet', 'Crown'])
+
+        output = json.loads(self.app.get(
+            '/api/v2/businesses/?q=0%25&match=substring'
+        ).get_data(as_text=True))
+        self.assertEqual(
+            [b['name'] for b in output['businesses']], ['100% Crow'])
+
+    def test_search_businesses_fuzzy(self):
+        """Test match=fuzzy tolerates typos, closest names first
+        """
+        self.register_business()
+        token = self.token()
+        for name in ['Crown Paints', 'Naivas']:
+            self.app.post(
+                '/api/v2/businesses/',
+                data=json.dumps(dict(self.new_business_info, name=name)),
+                headers={
+                    "content-type": "application/json",
+                    "x-access-token": token})
+
+        output = json.loads(self.app.get(
+            '/api/v2/businesses/?q=crown+pants&match=fuzzy'
+        ).get_data(as_text=True))
+        self.assertEqual(
+            [b['name'] for b in output['businesses']],
+            ['Crown Paints', 'Crown'])
+
+    def test_search_businesses_fuzzy_threshold(self):
+        """Test match=fuzzy leaves out names under the similarity threshold
+        """
+        self.register_business()
+        threshold = app.config['TRIGRAM_SIMILARITY_THRESHOLD']
+        app.config['TRIGRAM_SIMILARITY_THRESHOLD'] = 0.9
+        try:
+            loose = self.app.get('/api/v2/businesses/?q=crwn&match=fuzzy')
+        finally:
+            app.config['TRIGRAM_SIMILARITY_THRESHOLD'] = threshold
+        close = self.app.get('/api/v2/businesses/?q=crwn&match=fuzzy')
+        self.assertEqual(loose.status_code, 200)
+        self.assertNotIn('businesses', json.loads(
+            loose.get_data(as_text=True)))
+        self.assertEqual(
+            [b['name'] for b in json.loads(
+                close.get_data(as_text=True))['businesses']], ['Crown'])
+
+    def test_search_businesses_unknown_match(self):
+        """Test an unknown match mode is rejected
+        """
+        response = self.app.get('/api/v2/businesses/?q=crown&match=regex')
+        self.assertEqual(response.status_code, 400)
+
+    def test_suggest_businesses(self):
+        """Test suggestions follow creates, renames and deletes
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        token = self.token()
+        self.app.post(
+            '/api/v2/businesses/',
+            data=json.dumps(dict(self.new_business_info, name='Crown Paints')),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token})
+
+        def suggest(prefix):
+            output = json.loads(self.app.get(
+                '/api/v2/businesses/suggest?q={}'.format(prefix)
+            ).get_data(as_text=True))
+            return [s['name'] for s in output['suggestions']]
+
+        self.assertEqual(suggest('CR'), ['Crown', 'Crown Paints'])
+        self.assertEqual(suggest('pai'), ['Crown Paints'])
+        self.assertEqual(suggest(''), [])
+
+        self.app.put(
+            '/api/v2/businesses/{}'.format(business_id),
+            data=json.dumps(dict(self.new_business_info, name='Bata')),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token})
+        self.assertEqual(suggest('cr'), ['Crown Paints'])
+        self.assertEqual(suggest('ba'), ['Bata'])
+
+        self.app.delete(
+            '/api/v2/businesses/{}'.format(business_id),
+            headers={"x-access-token": token})
+        self.assertEqual(suggest('ba'), [])
+
+    def test_suggest_index_skips_blank_names(self):
+        """Test a business losing its name leaves the index
+        """
+        business_names.upsert(1, 'Crown Paints')
+        business_names.upsert(2, None)
+        business_names.upsert(1, ' ')
+        self.assertEqual(business_names.search('cr', 10), [])
+        self.assertEqual(len(business_names), 0)
+
+    def test_read_businesses_query_budget(self):
+        """Test listing stays within one query however many owners
+        """
+        for number in range(1, 5):
+            self.add_owner(number)
+        response = self.app.get('/api/v2/businesses/?limit=10')
+        output = json.loads(response.get_data(as_text=True))
+        self.assertEqual(len(output['businesses']), 4)
+        self.assertQueryBudget(response, 1)
+
+    def test_read_business_is_cached_until_updated(self):
+        """Test a business is served from cache until it changes
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        url = '/api/v2/businesses/{}'.format(business_id)
+        # the same business spelt with a leading zero
+        padded = '/api/v2/businesses/0{}'.format(business_id)
+
+        for path in [url, padded]:
+            self.assertEqual(self.app.get(path).headers['X-Cache'], 'MISS')
+            response = self.app.get(path)
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+            self.assertQueryBudget(response, 0)
+
+        self.app.put(
+            url,
+            data=json.dumps(self.update_business_info),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": self.token()})
+        for path in [url, padded]:
+            response = self.app.get(path)
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            output = json.loads(response.get_data(as_text=True))
+            self.assertEqual(
+                output['business']['name'], self.update_business_info['name'])
+
+    def test_read_business_conditional_get(self):
+        """Test validators answer 304 until the business changes
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        url = '/api/v2/businesses/{}'.format(business_id)
+
+        response = self.app.get(url)
+        etag = response.headers['ETag']
+        self.assertIn('public', response.headers['Cache-Control'])
+
+        for validators in [{'If-None-Match': etag}, {
+                'If-Modified-Since': response.headers['Last-Modified']}]:
+            response = self.app.get(url, headers=validators)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b'')
+
+        self.app.put(
+            url,
+            data=json.dumps(self.update_business_info),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": self.token()})
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_response_cache_kill_switch(self):
+        """Test RESPONSE_CACHE_ENABLED off skips the cache
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        app.config['RESPONSE_CACHE_ENABLED'] = False
+        try:
+            for _ in range(2):
+                response = self.app.get(
+                    '/api/v2/businesses/{}'.format(business_id))
+                self.assertNotIn('X-Cache', response.headers)
+        finally:
+            app.config['RESPONSE_CACHE_ENABLED'] = True
+
+    def test_postgres_cache_tier_invalidates_every_worker(self):
+        """Test a write in one worker drops what another has cached
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        url = '/api/v2/businesses/{}'.format(business_id)
+        storage = app.config['RESPONSE_CACHE_STORAGE']
+        app.config['RESPONSE_CACHE_STORAGE'] = 'postgres'
+        response_cache._shared = None
+        try:
+            self.assertEqual(self.app.get(url).headers['X-Cache'], 'MISS')
+            self.assertEqual(self.app.get(url).headers['X-Cache'], 'HIT')
+            # the same business written by another worker
+            other = ResponseCache(app, db)
+            other.invalidate(business_tag(business_id))
+            self.assertEqual(self.app.get(url).headers['X-Cache'], 'MISS')
+        finally:
+            response_cache.clear()
+            app.config['RESPONSE_CACHE_STORAGE'] = storage
+            response_cache._shared = None
+
+    def test_memory_cache_is_off_with_several_workers(self):
+        """Test tag versions held in one process never serve several
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        app.config['WEB_CONCURRENCY'] = 2
+        try:
+            response = self.app.get(
+                '/api/v2/businesses/{}'.format(business_id))
+        finally:
+            app.config['WEB_CONCURRENCY'] = 1
+        self.assertNotIn('X-Cache', response.headers)
+
+    def test_sqlite_cache_tier_is_shared(self):
+        """Test two tiers on one file share entries and tag versions
+        """
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        try:
+            first, second = SQLiteTier(path), SQLiteTier(path)
+            first.set('/b/1|business:1=0', {'body': '{}'}, 2 ** 40)
+            self.assertEqual(second.get('/b/1|business:1=0'), {'body': '{}'})
+            second.bump(['business:1'])
+            self.assertEqual(
+                first.versions(['business:1', 'business:2']), [1, 0])
+        finally:
+            os.remove(path)
+
+    def test_read_businesses_with_total(self):
+        """Test totals are only counted when asked for
+        """
+        self.register_business()
+        output = json.loads(self.app.get(
+            '/api/v2/businesses/').get_data(as_text=True))
+        self.assertNotIn('total', output)
+
+        output = json.loads(self.app.get(
+            '/api/v2/businesses/?total=exact').get_data(as_text=True))
+        self.assertEqual(output['total'], 1)
+
+        output = json.loads(self.app.get(
+            '/api/v2/businesses/?total=estimate').get_data(as_text=True))
+        self.assertIsInstance(output['total'], int)
+
+        response = self.app.get('/api/v2/businesses/?total=all')
+        self.assertEqual(response.status_code, 400)
+
+    def test_read_businesses_limit_is_capped(self):
+        """Test limit above the maximum is clamped and bad cursors refused
+        """
+        self.register_business()
+        response = self.app.get('/api/v2/businesses/?limit=100000')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get('/api/v2/businesses/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Invalid cursor', str(response.data))
+
     def test_read_if_no_businesses(self):
         """Test what happens when no businesses
         """
@@ -114,6 +448,68 @@ class TestBusinessV2(unittest.TestCase):
             db.exists().where(Business.name == _business['business']['name']))
         self.assertTrue(exists)
 
+    def test_update_business_to_taken_name(self):
+        """Test renaming onto an existing business name is refused
+        """
+        self.register_business()
+        token = self.token()
+        other = self.app.post(
+            '/api/v2/businesses/',
+            data=json.dumps(self.update_business_info),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token})
+        business_id = json.loads(
+            other.get_data(as_text=True))['business']['id']
+
+        response = self.app.put(
+            '/api/v2/businesses/{}'.format(business_id),
+            data=json.dumps(self.new_business_info),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token
+            }
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertIn(
+            'Business name {} already taken'.format(
+                self.new_business_info['name']),
+            str(response.data))
+
+    def test_update_business_if_match(self):
+        """Test If-Match applies an update once, a stale version gets 412"""
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        url = '/api/v2/businesses/{}'.format(business_id)
+        token = self.token()
+        etag = self.app.get(url).headers['ETag']
+
+        response = self.app.put(
+            url,
+            data=json.dumps(self.update_business_info),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token,
+                "If-Match": etag})
+        self.assertEqual(response.status_code, 201)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        output = json.loads(response.get_data(as_text=True))['business']
+        self.assertEqual(output['version'], 2)
+        # the update is the only statement
+        self.assertQueryBudget(response, 1)
+
+        response = self.app.put(
+            url,
+            data=json.dumps(self.new_business_info),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token,
+                "If-Match": etag})
+        self.assertEqual(response.status_code, 412)
+        output = json.loads(self.app.get(url).get_data(as_text=True))
+        self.assertEqual(
+            output['business']['name'], self.update_business_info['name'])
+
     def test_unsuccesful_update(self):
         """Test update if business doesn't exist"""
         self.register_user()
@@ -198,6 +594,32 @@ class TestBusinessV2(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertIn('Business Not Found', str(response.data))
 
+    def add_owner(self, number):
+        """Registers another user who creates a business"""
+        info = {
+            "username": "owner{}".format(number),
+            "fullname": "owner number",
+            "email": "owner{}@jkuat.comm".format(number),
+            "password": "password1234"
+        }
+        self.app.post(
+            '/api/v2/auth/register',
+            data=json.dumps(info),
+            content_type='application/json')
+        token = json.loads(self.app.post(
+            '/api/v2/auth/login',
+            data=json.dumps({
+                "username": info["username"],
+                "password": info["password"]}),
+            content_type='application/json').get_data(as_text=True))['token']
+        self.app.post(
+            '/api/v2/businesses/',
+            data=json.dumps(dict(
+                self.new_business_info, name='Business {}'.format(number))),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token})
+
     def register_user(self):
         return self.app.post(
             '/api/v2/auth/register',
@@ -233,6 +655,9 @@ class TestBusinessV2(unittest.TestCase):
         db.session.query(Business).delete()
         db.session.query(User).delete()
         db.session.commit()
+        # rows were deleted behind the suggestion index and the cache
+        business_names.build([])
+        response_cache.clear()
 
 
 if __name__ == '__main__':
@@ -1,10 +1,16 @@
+import datetime
+import gzip
+import shutil
+import tempfile
 import unittest
 import json
-from versions import app
+from versions import app, notification_broker, partitions
 from versions.v2.models import User, db, Notification, Business, Review
+from versions.v2.models import NotificationCounter
+from tests.base import BaseTestCase
 
 
-class TestNotification(unittest.TestCase):
+class TestNotification(BaseTestCase):
     def setUp(self):
         """Creates the app as test client
         """
@@ -37,6 +43,336 @@ class TestNotification(unittest.TestCase):
         warning = json.loads(response.get_data(as_text=True))['warning']
         self.assertEqual('user has no notifications', warning)
 
+    def test_get_notifications_query_budget(self):
+        """Test reading notifications stays within budget for any number
+        """
+        self.register()
+        token = json.loads(self.login().get_data(as_text=True))['token']
+        with app.app_context():
+            recipient = User.query.filter_by(username='victor').first()
+            for review_id in range(4):
+                Notification(
+                    recipient=recipient,
+                    actor='reviewer{}'.format(review_id),
+                    business_id=1,
+                    review_id=review_id).save()
+
+        response = self.app.get(
+            '/api/v2/notifications',
+            headers={"x-access-token": token})
+        notifications = json.loads(
+            response.get_data(as_text=True))['notifications']
+        self.assertEqual(len(notifications), 4)
+        self.assertTrue(all(n['read_at'] for n in notifications))
+        # marked read and returned by a single UPDATE, then counted
+        self.assertQueryBudget(response, 2)
+
+        response = self.app.get(
+            '/api/v2/notifications',
+            headers={"x-access-token": token})
+        warning = json.loads(response.get_data(as_text=True))['warning']
+        self.assertEqual('user has no notifications', warning)
+
+    def test_get_all_notifications_marks_unread(self):
+        """Test all notifications come back once each, all marked read
+        """
+        self.register()
+        token = json.loads(self.login().get_data(as_text=True))['token']
+        with app.app_context():
+            recipient = User.query.filter_by(username='victor').first()
+            for review_id in range(3):
+                Notification(
+                    recipient=recipient,
+                    actor='reviewer{}'.format(review_id),
+                    business_id=1,
+                    review_id=review_id).save()
+            recipient_id = recipient.id
+        self.app.get(
+            '/api/v2/notifications',
+            headers={"x-access-token": token})
+        with app.app_context():
+            Notification(
+                recipient_id=recipient_id,
+                actor='reviewer3',
+                business_id=1,
+                review_id=3).save()
+
+        response = self.app.get(
+            '/api/v2/notifications/all',
+            headers={"x-access-token": token})
+        notifications = json.loads(
+            response.get_data(as_text=True))['notifications']
+        self.assertEqual(
+            sorted(n['review_id'] for n in notifications), [0, 1, 2, 3])
+        self.assertTrue(all(n['read_at'] for n in notifications))
+        # the page, marking its unread rows, the counter
+        self.assertQueryBudget(response, 3)
+
+    def test_unread_count_and_inbox_pages(self):
+        """Test the counter follows reviews and reads, pages link up
+        """
+        self.register()
+        token = json.loads(self.login().get_data(as_text=True))['token']
+        business_id = self.create_business(token)
+        reviewer_token = self.login_reviewer()
+        for title in ['Good', 'Better', 'Best']:
+            self.review(business_id, title, reviewer_token)
+
+        def unread_count():
+            response = self.app.get(
+                '/api/v2/notifications/unread-count',
+                headers={"x-access-token": token})
+            self.assertQueryBudget(response, 1)
+            return json.loads(response.get_data(as_text=True))['unread']
+
+        self.assertEqual(unread_count(), 3)
+        output = json.loads(self.app.get(
+            '/api/v2/notifications?limit=1',
+            headers={"x-access-token": token}).get_data(as_text=True))
+        self.assertEqual(len(output['notifications']), 1)
+        self.assertEqual(output['unread'], 2)
+        self.assertEqual(unread_count(), 2)
+
+        seen, cursor = [], ''
+        while cursor is not None:
+            output = json.loads(self.app.get(
+                '/api/v2/notifications/all?limit=2&cursor={}'.format(cursor),
+                headers={"x-access-token": token}).get_data(as_text=True))
+            seen.extend(n['id'] for n in output['notifications'])
+            cursor = output['next']
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(len(set(seen)), 3)
+        self.assertEqual(unread_count(), 0)
+
+    def test_reviews_coalesce_within_window(self):
+        """Test reviews of one business in a window share a notification
+        """
+        self.register()
+        token = json.loads(self.login().get_data(as_text=True))['token']
+        business_id = self.create_business(token)
+        reviewer_token = self.login_reviewer()
+        app.config['NOTIFICATION_COALESCE_WINDOW'] = 3600
+        try:
+            for title in ['Good', 'Better', 'Best']:
+                self.review(business_id, title, reviewer_token)
+        finally:
+            app.config['NOTIFICATION_COALESCE_WINDOW'] = 0
+
+        output = json.loads(self.app.get(
+            '/api/v2/notifications',
+            headers={"x-access-token": token}).get_data(as_text=True))
+        self.assertEqual(len(output['notifications']), 1)
+        notification = output['notifications'][0]
+        self.assertEqual(notification['actor_count'], 3)
+        self.assertEqual(notification['actors'], ['oliver'] * 3)
+        self.assertEqual(
+            notification['act'],
+            'oliver and 2 others reviewed one of your businesses')
+        self.assertEqual(output['unread'], 0)
+        with app.app_context():
+            row = Notification.query.first()
+            first, second = [
+                review.created_at for review in
+                Review.query.order_by(Review.created_at).limit(2)]
+        # dated by the first review, only window_start is rounded down
+        self.assertTrue(first <= row.created_at <= second)
+        self.assertLessEqual(row.window_start, row.created_at)
+
+    def test_partitions_created_ahead_and_archived(self):
+        """Test months get partitions ahead and read ones are archived
+        """
+        self.register()
+        directory = tempfile.mkdtemp()
+        try:
+            with app.app_context():
+                # no partition for the month yet, kept by the default one
+                recipient = User.query.filter_by(username='victor').first()
+                notification = Notification(
+                    recipient=recipient, actor='oliver', business_id=1,
+                    review_id=1, read_at=datetime.datetime(2031, 1, 21))
+                notification.created_at = datetime.datetime(2031, 1, 20)
+                notification.window_start = notification.created_at
+                notification.save()
+
+                created = partitions.create_ahead(
+                    1, today=datetime.date(2031, 1, 15))
+                self.assertEqual(
+                    created, ['notifications_2031_01', 'notifications_2031_02'])
+                self.assertEqual(partitions.create_ahead(
+                    1, today=datetime.date(2031, 1, 15)), [])
+                self.assertEqual(db.session.execute(
+                    'SELECT count(*) FROM notifications_2031_01').scalar(), 1)
+
+                unread = Notification(
+                    recipient=recipient, actor='oliver', business_id=1,
+                    review_id=2)
+                unread.created_at = datetime.datetime(2031, 2, 20)
+                unread.window_start = unread.created_at
+                unread.save()
+
+                archived = partitions.archive(
+                    30, directory, today=datetime.date(2031, 4, 1))
+                self.assertIn('notifications_2031_01', archived)
+                # still holds an unread notification
+                self.assertNotIn('notifications_2031_02', archived)
+                self.assertNotIn(
+                    datetime.date(2031, 1, 1), partitions.attached())
+                with gzip.open(
+                        archived['notifications_2031_01'], 'rt') as archive:
+                    rows = archive.read().splitlines()
+                self.assertTrue(rows[0].startswith('id,recipient_id'))
+                self.assertEqual(len(rows), 2)
+        finally:
+            shutil.rmtree(directory)
+            with app.app_context():
+                db.session.query(Notification).delete()
+                db.session.execute(
+                    'DROP TABLE IF EXISTS notifications_2031_01, '
+                    'notifications_2031_02')
+                db.session.commit()
+                # archiving as of 2031 dropped the months in use too
+                partitions.create_ahead(
+                    app.config['NOTIFICATION_PARTITIONS_AHEAD'])
+
+    def test_stream_pushes_and_resumes(self):
+        """Test the stream replays missed notifications then pushes new ones
+        """
+        self.register()
+        token = json.loads(self.login().get_data(as_text=True))['token']
+        business_id = self.create_business(token)
+        reviewer_token = self.login_reviewer()
+        self.review(business_id, 'Good', reviewer_token)
+        self.review(business_id, 'Better', reviewer_token)
+        with app.app_context():
+            first, second = [
+                (row.id, row.event_id) for row in
+                Notification.query.order_by(Notification.id)]
+
+        response = self.app.get(
+            '/api/v2/notifications/stream?token={}'.format(token),
+            headers={
+                "Accept": "text/event-stream", "Last-Event-ID": str(first[1])},
+            environ_overrides={'wsgi.multithread': True}, buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        try:
+            self.assertTrue(next(chunks).decode().startswith('retry: '))
+            replayed = next(chunks).decode()
+            self.assertIn('id: {}\n'.format(second[1]), replayed)
+            self.assertIn('event: notification\n', replayed)
+
+            self.review(business_id, 'Best', reviewer_token)
+            pushed = next(chunks).decode()
+            data = json.loads(pushed.split('data: ')[1])
+            self.assertEqual(data['id'], second[0] + 1)
+            self.assertEqual(data['actor'], 'oliver')
+            self.assertEqual(data['recipient_id'], 'victor')
+        finally:
+            response.close()
+
+        response = self.app.get(
+            '/api/v2/notifications/stream',
+            headers={"x-access-token": token, "Last-Event-ID": "latest"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream_replays_reviews_folded_while_away(self):
+        """Test a fold gets a new event id, replayed after a reconnect
+        """
+        self.register()
+        token = json.loads(self.login().get_data(as_text=True))['token']
+        business_id = self.create_business(token)
+        reviewer_token = self.login_reviewer()
+        app.config['NOTIFICATION_COALESCE_WINDOW'] = 3600
+        try:
+            self.review(business_id, 'Good', reviewer_token)
+            with app.app_context():
+                seen = Notification.query.first().event_id
+            # folded into the notification the client has already seen
+            self.review(business_id, 'Better', reviewer_token)
+        finally:
+            app.config['NOTIFICATION_COALESCE_WINDOW'] = 0
+
+        response = self.app.get(
+            '/api/v2/notifications/stream?token={}'.format(token),
+            headers={
+                "Accept": "text/event-stream", "Last-Event-ID": str(seen)},
+            environ_overrides={'wsgi.multithread': True}, buffered=False)
+        chunks = iter(response.response)
+        try:
+            next(chunks)
+            replayed = next(chunks).decode()
+        finally:
+            response.close()
+        self.assertNotIn('id: {}\n'.format(seen), replayed)
+        self.assertEqual(
+            json.loads(replayed.split('data: ')[1])['actor_count'], 2)
+
+    def test_stream_refused_without_a_free_thread(self):
+        """Test streams are turned away on a worker without threads and
+        past SSE_MAX_STREAMS on a threaded one
+        """
+        self.register()
+        token = json.loads(self.login().get_data(as_text=True))['token']
+        url = '/api/v2/notifications/stream?token={}'.format(token)
+        headers = {"Accept": "text/event-stream"}
+
+        response = self.app.get(url, headers=headers)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+
+        max_streams = app.config['SSE_MAX_STREAMS']
+        app.config['SSE_MAX_STREAMS'] = 1
+        opened = self.app.get(
+            url, headers=headers, buffered=False,
+            environ_overrides={'wsgi.multithread': True})
+        try:
+            self.assertEqual(opened.status_code, 200)
+            response = self.app.get(
+                url, headers=headers,
+                environ_overrides={'wsgi.multithread': True})
+            self.assertEqual(response.status_code, 503)
+        finally:
+            opened.close()
+            app.config['SSE_MAX_STREAMS'] = max_streams
+        self.assertEqual(notification_broker.stats()['streams'], 0)
+
+    def create_business(self, token):
+        return json.loads(self.app.post(
+            '/api/v2/businesses/',
+            data=json.dumps({
+                "name": "Crown", "logo": "url", "category": "Paint",
+                "location": "NBO", "bio": "if you like it crown it"}),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token}
+        ).get_data(as_text=True))['business']['id']
+
+    def login_reviewer(self):
+        self.app.post(
+            '/api/v2/auth/register',
+            data=json.dumps({
+                'username': 'oliver',
+                'fullname': 'oliver mutai',
+                'email': 'oliver.mutai@gmail.com',
+                'password': 'password1234'
+            }),
+            content_type='application/json')
+        return json.loads(self.app.post(
+            '/api/v2/auth/login',
+            data=json.dumps({
+                'username': 'oliver', 'password': 'password1234'}),
+            content_type='application/json'
+        ).get_data(as_text=True))['token']
+
+    def review(self, business_id, title, token):
+        return self.app.post(
+            '/api/v2/businesses/{}/reviews'.format(business_id),
+            data=json.dumps({"title": title, "desc": "lorem ipsum"}),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token})
+
     def register(self):
         return self.app.post(
             '/api/v2/auth/register',
@@ -54,6 +390,7 @@ class TestNotification(unittest.TestCase):
     def tearDown(self):
         """Clean-up db"""
         db.session.query(Notification).delete()
+        db.session.query(NotificationCounter).delete()
         db.session.query(Review).delete()
         db.session.query(Business).delete()
         db.session.query(User).delete()
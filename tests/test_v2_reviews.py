@@ -1,10 +1,12 @@
 import json
 import unittest
-from versions import app
-from versions.v2.models import User, db, Business, Review
+from versions import app, response_cache
+from versions.v2.models import User, db, Business, Review, Notification
+from versions.v2.models import NotificationCounter
+from tests.base import BaseTestCase
 
 
-class TestReviewV2(unittest.TestCase):
+class TestReviewV2(BaseTestCase):
     def setUp(self):
         app.config.from_object('config.Testing')
         self.app = app.test_client()
@@ -104,6 +106,180 @@ class TestReviewV2(unittest.TestCase):
             db.exists().where(Review.title == self.new_review['title']))
         self.assertTrue(exists)
 
+    def test_read_reviews_query_budget(self):
+        """Listing reviews stays within budget however many reviewers
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        for reviewer in range(1, 5):
+            token = self.add_reviewer(reviewer, business_id)
+
+        response = self.app.get(
+            '/api/v2/businesses/{}/reviews'.format(business_id))
+        self.assertEqual(
+            len(json.loads(response.get_data(as_text=True))['reviews']), 4)
+        # the business, the validator probe, then the reviews with
+        # their reviewers
+        self.assertQueryBudget(response, 3)
+
+        response = self.app.get(
+            '/api/v2/businesses/reviews',
+            headers={"x-access-token": token})
+        self.assertEqual(
+            len(json.loads(response.get_data(as_text=True))['Reviews']), 4)
+        self.assertQueryBudget(response, 1)
+
+    def test_read_reviews_cache_follows_new_reviews(self):
+        """A new review invalidates the cached reviews of its business
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        url = '/api/v2/businesses/{}/reviews'.format(business_id)
+        self.add_reviewer(1, business_id)
+
+        self.assertEqual(self.app.get(url).headers['X-Cache'], 'MISS')
+        self.assertEqual(self.app.get(url).headers['X-Cache'], 'HIT')
+
+        self.add_reviewer(2, business_id)
+        response = self.app.get(url)
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(
+            len(json.loads(response.get_data(as_text=True))['reviews']), 2)
+
+    def test_read_reviews_not_modified_skips_fetch(self):
+        """A client holding the current reviews gets a 304 from the probe
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        url = '/api/v2/businesses/{}/reviews'.format(business_id)
+        self.add_reviewer(1, business_id)
+        etag = self.app.get(url).headers['ETag']
+
+        response_cache.clear()
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        # the business and the probe, the reviews are never read
+        self.assertQueryBudget(response, 2)
+
+        self.add_reviewer(2, business_id)
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_read_reviews_ignores_if_modified_since(self):
+        """A date cannot tell a deleted review, lists answer the ETag only
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        url = '/api/v2/businesses/{}/reviews'.format(business_id)
+        self.add_reviewer(1, business_id)
+        response = self.app.get(url)
+        self.assertNotIn('Last-Modified', response.headers)
+
+        response_cache.clear()
+        response = self.app.get(url, headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_update_review_if_match(self):
+        """Update a review at the version read, a stale one gets 412
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        token = self.add_reviewer(1, business_id)
+        review = json.loads(self.app.get(
+            '/api/v2/businesses/{}/reviews'.format(business_id)
+        ).get_data(as_text=True))['reviews'][0]
+        url = '/api/v2/businesses/{}/reviews/{}'.format(
+            business_id, review['id'])
+        etag = '"review-{}-v{}"'.format(review['id'], review['version'])
+        edit = {"title": "Saturday 14th", "desc": self.new_review['desc']}
+
+        response = self.app.put(
+            url, data=json.dumps(edit),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token,
+                "If-Match": etag})
+        self.assertEqual(response.status_code, 201)
+        output = json.loads(response.get_data(as_text=True))['review']
+        self.assertEqual(output['title'], edit['title'])
+        self.assertEqual(output['business'], self.new_business_info['name'])
+        self.assertEqual(output['version'], review['version'] + 1)
+
+        response = self.app.put(
+            url, data=json.dumps(self.new_review),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token,
+                "If-Match": etag})
+        self.assertEqual(response.status_code, 412)
+
+        # the business owner did not write it
+        response = self.app.put(
+            url, data=json.dumps(self.new_review),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": self.token()})
+        self.assertEqual(response.status_code, 401)
+
+    def test_update_review_of_another_business(self):
+        """Update a review under a business it does not belong to is 404
+        """
+        business_id = json.loads(self.register_business().get_data(
+            as_text=True))['business']['id']
+        token = self.add_reviewer(1, business_id)
+        review_id = json.loads(self.app.get(
+            '/api/v2/businesses/{}/reviews'.format(business_id)
+        ).get_data(as_text=True))['reviews'][0]['id']
+        other_id = json.loads(self.app.post(
+            '/api/v2/businesses/',
+            data=json.dumps(dict(self.new_business_info, name='Naivas')),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": self.token()}
+        ).get_data(as_text=True))['business']['id']
+        edit = {"title": "Saturday 14th", "desc": self.new_review['desc']}
+
+        for business in [other_id, other_id + 1000]:
+            response = self.app.put(
+                '/api/v2/businesses/{}/reviews/{}'.format(
+                    business, review_id),
+                data=json.dumps(edit),
+                headers={
+                    "content-type": "application/json",
+                    "x-access-token": token})
+            self.assertEqual(response.status_code, 404)
+        review = json.loads(self.app.get(
+            '/api/v2/businesses/{}/reviews'.format(business_id)
+        ).get_data(as_text=True))['reviews'][0]
+        self.assertEqual(review['title'], self.new_review['title'])
+
+    def add_reviewer(self, number, business_id):
+        """Registers another user who reviews the business"""
+        info = {
+            "username": "reviewer{}".format(number),
+            "fullname": "reviewer number",
+            "email": "reviewer{}@maseno.com".format(number),
+            "password": "password1234"
+        }
+        self.app.post(
+            '/api/v2/auth/register',
+            data=json.dumps(info),
+            content_type='application/json')
+        token = json.loads(self.app.post(
+            '/api/v2/auth/login',
+            data=json.dumps({
+                "username": info["username"],
+                "password": info["password"]}),
+            content_type='application/json').get_data(as_text=True))['token']
+        self.app.post(
+            '/api/v2/businesses/{}/reviews'.format(business_id),
+            data=json.dumps(self.new_review),
+            headers={
+                "content-type": "application/json",
+                "x-access-token": token})
+        return token
+
     def register_user(self):
         return self.app.post(
             '/api/v2/auth/register',
@@ -150,10 +326,13 @@ class TestReviewV2(unittest.TestCase):
 
     def tearDown(self):
         """Clean-up db"""
+        db.session.query(Notification).delete()
+        db.session.query(NotificationCounter).delete()
         db.session.query(Review).delete()
         db.session.query(Business).delete()
         db.session.query(User).delete()
         db.session.commit()
+        response_cache.clear()
 
 
 if __name__ == '__main__':
@@ -1,10 +1,13 @@
 import unittest
 import json
+from flask import Response
+from mock import patch
 from versions import app
 from versions.v2.models import User, db, Business
+from tests.base import BaseTestCase
 
 
-class TestUser(unittest.TestCase):
+class TestUser(BaseTestCase):
     def setUp(self):
         """Creates the app as test client"""
         app.config.from_object('config.Testing')
@@ -29,6 +32,42 @@ class TestUser(unittest.TestCase):
         output = json.loads(response.get_data(as_text=True))
         self.assertEqual(output[0]['username'], self.new_user_info['username'])
 
+    def test_read_all_users_query_budget(self):
+        """v2 Test listing users and their businesses costs two queries"""
+        self.register()
+        self.create_business()
+        response = self.app.get('/api/v2/users')
+        self.assertIn('X-DB-Query-Time', response.headers)
+        self.assertQueryBudget(response, 2)
+
+    def test_read_user_conditional_get(self):
+        """v2 Test a user read is revalidated and kept out of shared caches"""
+        self.register()
+        user_id = User.query.filter_by(
+            username=self.new_user_info['username']).first().id
+        url = '/api/v2/users/{}'.format(user_id)
+        response = self.app.get(url)
+        self.assertIn('private', response.headers['Cache-Control'])
+
+        response = self.app.get(
+            url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_repeated_queries_are_flagged(self):
+        """v2 Test the same statement sent again and again is logged"""
+        threshold = app.config['QUERY_REPEAT_THRESHOLD']
+        with patch.object(app.logger, 'warning') as warning:
+            with app.test_request_context('/api/v2/users'):
+                app.preprocess_request()
+                for user_id in range(threshold):
+                    User.query.filter_by(id=user_id).first()
+                response = app.process_response(Response())
+
+        self.assertEqual(
+            response.headers['X-DB-Query-Count'], str(threshold))
+        line = json.loads(warning.call_args[0][0])
+        self.assertEqual(line['repeated'][0]['times'], threshold)
+
     def test_read_one_user(self):
         """v2 Test endpoint for one user"""
         new_user = self.register()
@@ -10,56 +10,116 @@ Why do this; it reduces lines of code within a single file
 and its an easy read
 """
 import os
+import datetime
 import jwt
+from collections import namedtuple
 from functools import wraps
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from versions import metrics
+from versions.broker import make_broker
+from versions.cache import LRUCache
+from versions.hashing import HashingPool
+from versions.instrumentation import QueryInstrumentation
+from versions.mailer import MailTransport, TemplateCache
+from versions.ratelimit import RateLimiter
+from versions.responsecache import ResponseCache
+from versions.revocation import RevocationCache, token_digest
+from versions.suggest import PrefixIndex
 
 
 app = Flask(__name__)
 app.config.from_object('config.{}'.format(os.getenv('ENVIRON')))
 CORS(app)
 mail = Mail(app)
+mail_transport = MailTransport(app, mail)
+email_templates = TemplateCache(app)
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
+query_stats = QueryInstrumentation(app)
+metrics.register('queries', query_stats.stats)
+revoked_tokens = RevocationCache(
+    app.config['REVOCATION_CACHE_PATH'],
+    app.config['REVOCATION_CACHE_BITS'],
+    app.config['REVOCATION_CACHE_HASHES'],
+    app.config['ACCESS_TOKEN_MINUTES'] * 60
+)
+metrics.register('revocation_cache', revoked_tokens.stats)
+decoded_tokens = LRUCache(app.config['TOKEN_CACHE_SIZE'])
+metrics.register('token_cache', decoded_tokens.stats)
+hashing_pool = HashingPool(app)
+metrics.register('hashing_pool', hashing_pool.stats)
+metrics.register('mail_transport', mail_transport.stats)
+limiter = RateLimiter(app)
+metrics.register('rate_limiter', limiter.stats)
+response_cache = ResponseCache(app, db)
+metrics.register('response_cache', response_cache.stats)
+business_names = PrefixIndex(app.config['SUGGEST_INDEX_MAX_AGE'])
+metrics.register('business_names', business_names.stats)
+notification_broker = make_broker(app, db)
+metrics.register('notification_broker', notification_broker.stats)
+
+# the authenticated user as described by the signed token claims
+Principal = namedtuple('Principal', ['id', 'username', 'activate', 'family'])
+
 
 def login_required(f):
     """Ensures user is logged in before action
     Checks of token is provided in header
     decodes the token then returns current user info
+    as a Principal so views need not reload the user row
+    EventSource cannot set headers, event streams may pass ?token=
     """
     @wraps(f)
     def wrap(*args, **kwargs):
         token = None
         if 'x-access-token' in request.headers:
             token = request.headers['x-access-token']
+        elif request.accept_mimetypes.best == 'text/event-stream':
+            token = request.args.get('token')
 
         if not token:
             return jsonify({
                 'warning': 'Missing token. Please register or login'
             }), 401
 
-        is_token_valid = versions.v2.models.AuthToken.query.filter_by(token=token).first()
+        digest = token_digest(token)
 
-        is_token_valid = is_token_valid.valid if is_token_valid else True
+        # only tokens the shared filter flags as revoked hit the db
+        if revoked_tokens.might_be_revoked(digest):
+            is_token_valid = versions.v2.models.AuthToken.query.filter_by(
+                digest=digest).first()
 
-        if not is_token_valid:
-            return jsonify({ 'warning': 'Login again'}), 401
+            is_token_valid = is_token_valid.valid if is_token_valid else True
 
-        try:
-            data = jwt.decode(token, app.config['SECRET_KEY'])
-            current_user = data['id']
-        except jwt.ExpiredSignatureError:
-            return jsonify({
-                'warning': 'Expired token. Please login to get a new token'
-            }), 401
-        except ValueError:
-            return jsonify({
-                'warning': 'Invalid token. Please register or login'
-            }), 401
+            if not is_token_valid:
+                decoded_tokens.pop(digest)
+                return jsonify({ 'warning': 'Login again'}), 401
+
+        # claims are cached until the token expires
+        data = decoded_tokens.get(digest)
+        if data is None:
+            try:
+                data = jwt.decode(token, app.config['SECRET_KEY'])
+            except jwt.ExpiredSignatureError:
+                return jsonify({
+                    'warning': 'Expired token. Please login to get a new token'
+                }), 401
+            except ValueError:
+                return jsonify({
+                    'warning': 'Invalid token. Please register or login'
+                }), 401
+            decoded_tokens.set(digest, data, expires_at=data['exp'])
+
+        current_user = Principal(
+            data['id'],
+            data.get('username'),
+            data.get('activate'),
+            data.get('fam')
+        )
 
         return f(current_user, *args, **kwargs)
     return wrap
@@ -71,6 +131,21 @@ import versions.v2.user
 import versions.v2.business
 import versions.v2.review
 import versions.v2.notifications
+import versions.outbox
+import versions.partitions
+import versions.commands
+
+
+@app.before_first_request
+def load_revoked_tokens():
+    """Rebuild the revocation filter from authtokens as a worker starts"""
+    AuthToken = versions.v2.models.AuthToken
+    revoked_tokens.rebuild([
+        row.digest for row in db.session.query(AuthToken.digest).filter(
+            AuthToken.valid == False,
+            AuthToken.expires_at > datetime.datetime.utcnow()
+        )
+    ])
 
 # version 2 routes
 app.register_blueprint(versions.v2.auth.mod, url_prefix='/api/v2/auth')
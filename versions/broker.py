@@ -0,0 +1,147 @@
+"""Fan-out of new notifications to open event streams
+A stream subscribes for its user and receives every event published for
+that user until it unsubscribes. Events are published once the
+notification is committed, streams that miss one while disconnected
+replay it from the table with Last-Event-ID.
+
+NOTIFICATION_BROKER picks how events travel
+    local       within this process, for a single worker
+    postgres    LISTEN/NOTIFY, every worker connected to the database
+                receives every event and hands it to its own streams
+"""
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+
+class LocalBroker(object):
+    """Queues of the streams open in this process"""
+
+    def __init__(self):
+        self.published = 0
+        self.delivered = 0
+        self.refused = 0
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id, limit=None):
+        """Queue receiving the events of user_id
+        None when limit streams are already open in this process
+        """
+        events = queue.Queue()
+        with self._lock:
+            if limit is not None and sum(
+                    len(s) for s in self._subscribers.values()) >= limit:
+                self.refused += 1
+                return None
+            self._subscribers.setdefault(user_id, set()).add(events)
+        return events
+
+    def unsubscribe(self, user_id, events):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id, set())
+            subscribers.discard(events)
+            if not subscribers:
+                self._subscribers.pop(user_id, None)
+
+    def publish(self, user_id, event):
+        """Send event to the streams of user_id"""
+        self.published += 1
+        self.dispatch(user_id, event)
+
+    def dispatch(self, user_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for events in subscribers:
+            events.put(event)
+        self.delivered += len(subscribers)
+
+    def stats(self):
+        """Counters of this process"""
+        with self._lock:
+            streams = sum(len(s) for s in self._subscribers.values())
+        return {
+            'streams': streams,
+            'published': self.published,
+            'delivered': self.delivered,
+            'refused': self.refused
+        }
+
+
+class PostgresBroker(LocalBroker):
+    """Publishes with pg_notify, a listener thread per process dispatches
+    what arrives on the channel to the local streams
+    """
+    channel = 'notifications'
+
+    def __init__(self, db):
+        super(PostgresBroker, self).__init__()
+        self.db = db
+        self.reconnects = 0
+        self._pid = None
+
+    def subscribe(self, user_id, limit=None):
+        self._listen()
+        return super(PostgresBroker, self).subscribe(user_id, limit)
+
+    def publish(self, user_id, event):
+        """NOTIFY every worker, this process included"""
+        self.published += 1
+        self.db.session.execute(
+            self.db.text('SELECT pg_notify(:channel, :payload)'),
+            {'channel': self.channel, 'payload': json.dumps(
+                {'user_id': user_id, 'event': event})})
+        self.db.session.commit()
+
+    def _listen(self):
+        """Start the listener of this process, again after a fork"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='notify-listener')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._receive()
+            except Exception:
+                # the streams stay open, clients fill any gap with
+                # Last-Event-ID when they reconnect
+                self.reconnects += 1
+                time.sleep(1)
+
+    def _receive(self):
+        fairy = self.db.engine.raw_connection()
+        # a connection of its own, never handed back to the pool
+        fairy.detach()
+        connection = fairy.connection
+        connection.autocommit = True
+        try:
+            connection.cursor().execute('LISTEN {}'.format(self.channel))
+            while True:
+                if select.select([connection], [], [], 60) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    message = json.loads(connection.notifies.pop(0).payload)
+                    self.dispatch(message['user_id'], message['event'])
+        finally:
+            connection.close()
+
+    def stats(self):
+        stats = super(PostgresBroker, self).stats()
+        stats['reconnects'] = self.reconnects
+        return stats
+
+
+def make_broker(app, db):
+    """Broker named by NOTIFICATION_BROKER"""
+    if app.config['NOTIFICATION_BROKER'] == 'postgres':
+        return PostgresBroker(db)
+    return LocalBroker()
@@ -0,0 +1,63 @@
+"""Maintenance commands registered on the flask cli
+run with FLASK_APP=app.py e.g
+    flask purge-tokens --batch-size 500
+    flask outbox-worker
+    flask notification-partitions
+    flask archive-notifications
+"""
+import click
+from versions import app, outbox, partitions
+from versions.v2.models import AuthToken, RefreshToken
+
+
+@app.cli.command('purge-tokens')
+@click.option('--batch-size', default=1000, help='Rows deleted per transaction')
+def purge_tokens(batch_size):
+    """Delete expired access and refresh tokens in short batches"""
+    deleted = AuthToken.purge_expired(batch_size)
+    deleted += RefreshToken.purge_expired(batch_size)
+    click.echo('Purged {} expired tokens'.format(deleted))
+
+
+@app.cli.command('outbox-worker')
+@click.option('--batch-size', default=None, type=int,
+              help='Messages claimed per transaction')
+@click.option('--interval', default=None, type=float,
+              help='Seconds to sleep when the outbox is empty')
+@click.option('--once', is_flag=True, help='Drain a single batch and exit')
+def outbox_worker(batch_size, interval, once):
+    """Deliver queued emails"""
+    claimed = outbox.run(
+        batch_size or app.config['OUTBOX_BATCH_SIZE'],
+        interval or app.config['OUTBOX_POLL_INTERVAL'],
+        once=once
+    )
+    if once:
+        click.echo('Delivered a batch of {} emails'.format(claimed))
+
+
+@app.cli.command('notification-partitions')
+@click.option('--ahead', default=None, type=int,
+              help='Months to create past the current one')
+def notification_partitions(ahead):
+    """Create the notifications partitions of the coming months"""
+    if ahead is None:
+        ahead = app.config['NOTIFICATION_PARTITIONS_AHEAD']
+    created = partitions.create_ahead(ahead)
+    click.echo('Created {} partitions {}'.format(
+        len(created), ', '.join(created)))
+
+
+@app.cli.command('archive-notifications')
+@click.option('--retention-days', default=None, type=int,
+              help='Age in days past which read months are archived')
+@click.option('--directory', default=None,
+              help='Where the gzipped partitions are written')
+def archive_notifications(retention_days, directory):
+    """Archive and drop old months of read notifications"""
+    if retention_days is None:
+        retention_days = app.config['NOTIFICATION_RETENTION_DAYS']
+    archived = partitions.archive(
+        retention_days, directory or app.config['NOTIFICATION_ARCHIVE_DIR'])
+    click.echo('Archived {} partitions {}'.format(
+        len(archived), ', '.join(sorted(archived))))
@@ -0,0 +1,83 @@
+"""Conditional GETs
+Views give a response its validators with `validate`, an ETag built from
+ids and updated_at values plus the Last-Modified time. `@conditional`
+then answers requests carrying a matching If-None-Match or
+If-Modified-Since with an empty 304.
+
+List views compute an ETag from a max(updated_at) and count(*) probe
+first and return `not_modified()` when the client is up to date, so the
+rows are never fetched. Counting catches deletes, which leave
+max(updated_at) as it was. For the same reason lists send no
+Last-Modified, a date alone would answer If-Modified-Since with a 304
+after a delete.
+
+Single rows carry a version column instead and their ETag names it,
+updates sent with If-Match only apply to the version the client read.
+"""
+import hashlib
+from functools import wraps
+from flask import current_app, request
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(*parts):
+    """Strong ETag of the values a response was built from"""
+    return hashlib.sha1(
+        '|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def version_etag(kind, row_id, version):
+    """ETag of one versioned row, read back by if_match_version"""
+    return '{}-{}-v{}'.format(kind, row_id, version)
+
+
+def if_match_version(kind, row_id):
+    """Version If-Match expects the row to be at
+    None when any version will do, 0 when the ETag is not one of this
+    row so the update cannot match
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    prefix = '{}-{}-v'.format(kind, row_id)
+    for etag in if_match.as_set():
+        if etag.startswith(prefix) and etag[len(prefix):].isdigit():
+            return int(etag[len(prefix):])
+    return 0
+
+
+def validate(response, etag, last_modified, private=False):
+    """Set the validators and Cache-Control of a response"""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['HTTP_CACHE_MAX_AGE']
+    response.cache_control.must_revalidate = True
+    return response
+
+
+def is_fresh(etag, last_modified):
+    """True when the client already holds this version"""
+    return not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified)
+
+
+def not_modified(etag, last_modified, private=False):
+    """Empty 304 carrying the validators"""
+    return validate(
+        current_app.response_class(status=304), etag, last_modified, private)
+
+
+def conditional(f):
+    """Turn a 200 into a 304 when the request validators match it"""
+    @wraps(f)
+    def wrap(*args, **kwargs):
+        response = current_app.make_response(f(*args, **kwargs))
+        if response.status_code == 200:
+            response.make_conditional(request)
+        return response
+    return wrap
@@ -0,0 +1,210 @@
+"""Password hashing off the request worker
+sha256_crypt costs tens of milliseconds of CPU per call, so hashing and
+verification run in a small process pool.
+
+A request waiting on its job holds only its own thread of the gthread
+worker, the other threads keep serving.
+
+HASH_POOL_MAX_PENDING caps the jobs queued or running at once, callers
+past the cap get HashingPoolBusy straight away which is answered with a
+503. A job still running after HASH_POOL_TIMEOUT is answered the same way.
+HASH_POOL_STORAGE picks where jobs are counted
+    memory              per process
+    sqlite:///<path>    by every worker on the host, the cap then bounds
+                        the hashing backlog of the whole host
+
+cost is read from PASSWORD_HASH_ROUNDS, hashes made with fewer rounds
+are flagged for upgrade when they are next verified
+"""
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from passlib.context import CryptContext
+
+_contexts = {}
+
+
+def _context(rounds):
+    """CryptContext for a cost, built once per process"""
+    if rounds not in _contexts:
+        _contexts[rounds] = CryptContext(
+            schemes=['sha256_crypt'],
+            sha256_crypt__default_rounds=rounds,
+            sha256_crypt__min_rounds=rounds
+        )
+    return _contexts[rounds]
+
+
+def _hash(rounds, password):
+    return _context(rounds).hash(password)
+
+
+def _verify_and_update(rounds, password, hashed):
+    return _context(rounds).verify_and_update(password, hashed)
+
+
+class HashingPoolBusy(Exception):
+    """Raised when the hashing queue is full"""
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, 'Password hashing pool is saturated')
+        self.retry_after = retry_after
+
+
+class MemorySlots(object):
+    """Jobs counted in this process"""
+
+    def __init__(self):
+        self.taken = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, limit, expiry, now):
+        """Take a slot, None when limit are taken"""
+        with self._lock:
+            if self.taken >= limit:
+                return None
+            self.taken += 1
+            return self.taken
+
+    def release(self, slot):
+        with self._lock:
+            self.taken -= 1
+
+    def count(self):
+        return self.taken
+
+
+class SQLiteSlots(object):
+    """Jobs counted in a sqlite file shared by the workers of a host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS slots '
+                '(id INTEGER PRIMARY KEY, at REAL)')
+            self._local.connection = connection
+        return connection
+
+    def acquire(self, limit, expiry, now):
+        """Same contract as MemorySlots.acquire, slots older than expiry
+        seconds were left by a worker that died and are taken back
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'DELETE FROM slots WHERE at <= ?', (now - expiry,))
+            if connection.execute(
+                    'SELECT count(*) FROM slots').fetchone()[0] >= limit:
+                return None
+            return connection.execute(
+                'INSERT INTO slots (at) VALUES (?)', (now,)).lastrowid
+        finally:
+            connection.execute('COMMIT')
+
+    def release(self, slot):
+        self._connection().execute('DELETE FROM slots WHERE id = ?', (slot,))
+
+    def count(self):
+        return self._connection().execute(
+            'SELECT count(*) FROM slots').fetchone()[0]
+
+
+class HashingPool(object):
+    """Bounded process pool for password hashing
+    HASH_POOL_WORKERS = 0 runs jobs inline, still honouring the queue cap
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    @property
+    def slots(self):
+        if self._slots is None:
+            storage = self.app.config['HASH_POOL_STORAGE']
+            if storage.startswith('sqlite:///'):
+                self._slots = SQLiteSlots(storage[len('sqlite:///'):])
+            else:
+                self._slots = MemorySlots()
+        return self._slots
+
+    def _pool(self):
+        """Executor of this process, recreated after a fork"""
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.app.config['HASH_POOL_WORKERS'])
+            self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, job, *args):
+        config = self.app.config
+        slot = self.slots.acquire(
+            config['HASH_POOL_MAX_PENDING'], config['HASH_POOL_TIMEOUT'],
+            time.time())
+        with self._lock:
+            if slot is None:
+                self.rejected += 1
+                raise HashingPoolBusy(config['HASH_POOL_RETRY_AFTER'])
+            self.pending += 1
+        try:
+            if not config['HASH_POOL_WORKERS']:
+                return job(config['PASSWORD_HASH_ROUNDS'], *args)
+            future = self._pool().submit(
+                job, config['PASSWORD_HASH_ROUNDS'], *args)
+            try:
+                return future.result(config['HASH_POOL_TIMEOUT'])
+            except TimeoutError:
+                future.cancel()
+                with self._lock:
+                    self.timed_out += 1
+                raise HashingPoolBusy(config['HASH_POOL_RETRY_AFTER'])
+        finally:
+            self.slots.release(slot)
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def hash(self, password):
+        """Hash a password at the configured cost"""
+        return self._run(_hash, str(password))
+
+    def verify_and_update(self, password, hashed):
+        """Compare a password with a stored hash
+        returns (matches, new_hash), new_hash is None unless the stored
+        hash is below the configured cost and should be replaced
+        """
+        return self._run(_verify_and_update, str(password), hashed)
+
+    def verify(self, password, hashed):
+        """True when the password matches the stored hash"""
+        return self.verify_and_update(password, hashed)[0]
+
+    def stats(self):
+        """Queue counters of this process, queued is counted in
+        HASH_POOL_STORAGE
+        """
+        return {
+            'pending': self.pending,
+            'queued': self.slots.count(),
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'workers': self.app.config['HASH_POOL_WORKERS']
+        }
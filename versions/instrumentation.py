@@ -0,0 +1,120 @@
+"""Per request SQL accounting
+QueryInstrumentation listens to every statement sent through SQLAlchemy
+and totals the count and database time of the request being served.
+When a request is done the totals go out as one JSON log line and, unless
+switched off by QUERY_STATS_HEADERS, as X-DB-Query-Count and
+X-DB-Query-Time (milliseconds) response headers.
+
+The same statement text sent QUERY_REPEAT_THRESHOLD times or more within
+one request is reported as repeated, the usual sign of a lazy load
+inside a loop (N+1).
+"""
+import json
+import threading
+import time
+from collections import Counter
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestQueries(object):
+    """Statements of a single request"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[statement] += 1
+
+    def repeated(self, threshold):
+        """(statement, times) sent at least threshold times, most first"""
+        return [
+            (statement, times)
+            for statement, times in self.shapes.most_common()
+            if times >= threshold
+        ]
+
+
+class QueryInstrumentation(object):
+    """Counts statements and database time per request"""
+
+    def __init__(self, app):
+        self.app = app
+        self.requests = 0
+        self.statements = 0
+        self.flagged = 0
+        self._lock = threading.Lock()
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    @staticmethod
+    def current():
+        """RequestQueries of the request being served, None outside one"""
+        if not has_request_context():
+            return None
+        return g.get('_queries')
+
+    def _before_execute(self, conn, cursor, statement, parameters,
+                        context, executemany):
+        conn.info['_query_started'] = time.time()
+
+    def _after_execute(self, conn, cursor, statement, parameters,
+                       context, executemany):
+        started = conn.info.pop('_query_started', None)
+        queries = self.current()
+        if queries is not None and started is not None:
+            queries.record(statement, time.time() - started)
+
+    def _start(self):
+        g._queries = RequestQueries()
+
+    def _finish(self, response):
+        queries = g.pop('_queries', None)
+        if queries is None:
+            return response
+
+        repeated = queries.repeated(self.app.config['QUERY_REPEAT_THRESHOLD'])
+        with self._lock:
+            self.requests += 1
+            self.statements += queries.count
+            self.flagged += 1 if repeated else 0
+
+        if self.app.config['QUERY_STATS_HEADERS']:
+            response.headers['X-DB-Query-Count'] = str(queries.count)
+            response.headers['X-DB-Query-Time'] = '{:.1f}'.format(
+                queries.duration * 1000)
+
+        line = json.dumps({
+            'event': 'request_queries',
+            'method': request.method,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'queries': queries.count,
+            'db_ms': round(queries.duration * 1000, 1),
+            'repeated': [
+                {'statement': statement, 'times': times}
+                for statement, times in repeated
+            ]
+        })
+        if repeated:
+            self.app.logger.warning(line)
+        else:
+            self.app.logger.info(line)
+        return response
+
+    def stats(self):
+        """Counters of this process"""
+        return {
+            'requests': self.requests,
+            'statements': self.statements,
+            'statements_per_request': float(self.statements) /
+            self.requests if self.requests else 0.0,
+            'requests_with_repeats': self.flagged
+        }
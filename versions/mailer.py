@@ -0,0 +1,134 @@
+"""Mail transport for the outbox worker
+MailTransport keeps a few authenticated SMTP connections open between
+batches and sends a whole batch over one of them, instead of the
+connect, login, send, quit round that mail.send does per message.
+
+TemplateCache compiles each email template once per process.
+"""
+import smtplib
+import socket
+import threading
+import time
+
+
+class TemplateCache(object):
+    """Compiled jinja templates kept for the life of the process"""
+
+    def __init__(self, app):
+        self.app = app
+        self._templates = {}
+
+    def render(self, template_name, context):
+        """Render like render_template, needs a request context for url_for"""
+        template = self._templates.get(template_name)
+        if template is None:
+            template = self.app.jinja_env.get_template(template_name)
+            self._templates[template_name] = template
+        self.app.update_template_context(context)
+        return template.render(context)
+
+
+class MailTransport(object):
+    """Small pool of open SMTP connections
+    idle connections older than MAIL_POOL_IDLE_TIMEOUT or failing NOOP
+    are dropped on checkout, at most MAIL_POOL_SIZE are kept
+    """
+
+    def __init__(self, app, mail):
+        self.app = app
+        self.mail = mail
+        self.sent = 0
+        self.failed = 0
+        self.batches = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.started = time.time()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        connection = self.mail.connect()
+        connection.__enter__()
+        self.connections_opened += 1
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, socket.error):
+            pass
+
+    def _alive(self, connection):
+        if connection.host is None:
+            return True
+        try:
+            return connection.host.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, last_used = self._idle.pop()
+            timeout = self.app.config['MAIL_POOL_IDLE_TIMEOUT']
+            if time.time() - last_used < timeout and self._alive(connection):
+                self.connections_reused += 1
+                return connection
+            self._close(connection)
+        return self._open()
+
+    def _checkin(self, connection):
+        with self._lock:
+            if len(self._idle) < self.app.config['MAIL_POOL_SIZE']:
+                self._idle.append((connection, time.time()))
+                return
+        self._close(connection)
+
+    def send_batch(self, messages):
+        """Send messages over one pooled connection
+        returns {index: error} for the messages that failed
+        a dropped connection is replaced for the rest of the batch
+        """
+        failures = {}
+        connection = None
+        for index, message in enumerate(messages):
+            try:
+                if connection is None:
+                    connection = self._checkout()
+                connection.send(message)
+                self.sent += 1
+            except (smtplib.SMTPServerDisconnected, socket.error) as error:
+                failures[index] = error
+                self.failed += 1
+                if connection is not None:
+                    self._close(connection)
+                    connection = None
+            except smtplib.SMTPException as error:
+                failures[index] = error
+                self.failed += 1
+        if connection is not None:
+            self._checkin(connection)
+        self.batches += 1
+        return failures
+
+    def stats(self):
+        """Throughput and connection reuse counters of this process"""
+        checkouts = self.connections_opened + self.connections_reused
+        elapsed = time.time() - self.started
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'batches': self.batches,
+            'messages_per_batch':
+                float(self.sent + self.failed) / self.batches
+                if self.batches else 0.0,
+            'messages_per_second': self.sent / elapsed if elapsed else 0.0,
+            'connections_opened': self.connections_opened,
+            'connections_reused': self.connections_reused,
+            'reuse_rate':
+                float(self.connections_reused) / checkouts
+                if checkouts else 0.0,
+            'idle_connections': len(self._idle)
+        }
@@ -0,0 +1,15 @@
+"""Registry of runtime counters exposed on /metrics
+Caches and pools register a callable returning a dict of their
+counters, the route collects a snapshot of every registered source
+"""
+_sources = {}
+
+
+def register(name, source):
+    """Register a callable that returns the counters for `name`"""
+    _sources[name] = source
+
+
+def snapshot():
+    """Collect current counters from every registered source"""
+    return {name: source() for name, source in _sources.items()}
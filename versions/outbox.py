@@ -0,0 +1,78 @@
+"""Delivery of queued emails
+Rows in the outbox table are claimed in batches with
+SELECT ... FOR UPDATE SKIP LOCKED so several workers can drain in parallel.
+A failed message is retried with exponential backoff and marked dead
+once OUTBOX_MAX_ATTEMPTS is reached.
+
+run against a local debugging server with
+    python -m smtpd -n -c DebuggingServer localhost:1025
+    MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_USE_SSL=false flask outbox-worker
+"""
+import datetime
+import json
+import time
+from versions import app, mail_transport
+from versions.utils import build_message
+from versions.v2.models import db, Outbox
+
+
+def deliver(rows):
+    """Send the rows as one batch, recording success or scheduling a retry
+    a row whose message cannot be built fails like one SMTP refused, so a
+    bad template or context ends up dead instead of stopping the worker
+    """
+    config = app.config
+    failures, messages, sent = {}, [], []
+    for index, row in enumerate(rows):
+        try:
+            messages.append(build_message(row))
+            sent.append(index)
+        except Exception as error:
+            failures[index] = error
+    for position, error in mail_transport.send_batch(messages).items():
+        failures[sent[position]] = error
+    now = datetime.datetime.utcnow()
+    for index, row in enumerate(rows):
+        error = failures.get(index)
+        if error is not None:
+            row.attempts += 1
+            row.last_error = str(error)[:255]
+            if row.attempts >= config['OUTBOX_MAX_ATTEMPTS']:
+                row.status = 'dead'
+            else:
+                row.next_attempt_at = now + datetime.timedelta(
+                    seconds=config['OUTBOX_RETRY_BACKOFF'] *
+                    2 ** (row.attempts - 1))
+            continue
+        row.status = 'sent'
+        row.sent_at = now
+        # the context may hold a temporary password
+        row.context = None
+
+
+def drain(batch_size):
+    """Deliver one batch of due messages
+    returns the number of rows claimed
+    """
+    rows = Outbox.query.filter(
+        Outbox.status == 'pending',
+        Outbox.next_attempt_at <= datetime.datetime.utcnow()
+    ).order_by(Outbox.id).limit(batch_size).with_for_update(
+        skip_locked=True).all()
+    if rows:
+        deliver(rows)
+    db.session.commit()
+    return len(rows)
+
+
+def run(batch_size, interval, once=False):
+    """Drain the outbox until stopped, sleeping while it is empty"""
+    while True:
+        claimed = drain(batch_size)
+        if claimed:
+            app.logger.info(
+                'outbox batch %s', json.dumps(mail_transport.stats()))
+        if once:
+            return claimed
+        if claimed < batch_size:
+            time.sleep(interval)
@@ -0,0 +1,82 @@
+"""Cursor pagination helpers for list endpoints
+cursors are opaque url safe tokens, clients send back the `next` value
+of a response to fetch the page after it.
+
+keyset cursors carry the (created_at, id) of the last row served so the
+next page is a range scan on that index instead of an OFFSET.
+offset cursors are used where rows are ordered by a computed rank
+"""
+import base64
+import binascii
+import datetime
+import json
+from flask import current_app
+
+TOTAL_MODES = ('exact', 'estimate')
+
+
+class InvalidCursor(ValueError):
+    """Raised for a cursor that was not produced by encode_cursor"""
+
+
+def encode_cursor(payload):
+    """Opaque token for a json serialisable payload"""
+    raw = json.dumps(payload, separators=(',', ':')).encode('UTF-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Payload of a token made by encode_cursor"""
+    try:
+        return json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('UTF-8'))
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+def keyset_cursor(created_at, row_id):
+    """Cursor pointing after the row with this (created_at, id)"""
+    return encode_cursor({'k': [created_at.isoformat(), row_id]})
+
+
+def keyset_values(payload):
+    """(created_at, id) from a decoded keyset cursor"""
+    try:
+        created_at, row_id = payload['k']
+        for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+            try:
+                return datetime.datetime.strptime(created_at, fmt), int(row_id)
+            except ValueError:
+                continue
+    except (KeyError, TypeError, ValueError):
+        pass
+    raise InvalidCursor(payload)
+
+
+def offset_value(payload):
+    """Row offset from a decoded offset cursor"""
+    try:
+        return max(0, int(payload['o']))
+    except (KeyError, TypeError, ValueError):
+        raise InvalidCursor(payload)
+
+
+def clamp_limit(limit):
+    """Page size bounded to 1..MAX_PAGE_LIMIT"""
+    return max(1, min(limit, current_app.config['MAX_PAGE_LIMIT']))
+
+
+def estimated_count(query):
+    """Planner row estimate for a query, cheap but approximate
+    databases other than postgres fall back to an exact count
+    """
+    session = query.session
+    dialect = session.get_bind().dialect
+    if dialect.name != 'postgresql':
+        return query.count()
+    compiled = query.statement.compile(dialect=dialect)
+    plan = session.connection().execute(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
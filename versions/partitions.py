@@ -0,0 +1,148 @@
+"""Monthly partitions of the notifications table
+notifications is range partitioned by window_start, one partition a month
+named notifications_YYYY_MM. window_start is created_at unless the
+notification was coalesced, then it is the start of its window.
+
+`create_ahead` adds the partitions of the coming months. Rows of a month
+without one land in notifications_default until its partition is made,
+they are moved over then.
+
+`archive` retires months older than NOTIFICATION_RETENTION_DAYS once every
+notification in them is read. The partition is copied to a gzipped CSV in
+NOTIFICATION_ARCHIVE_DIR, then detached and dropped in one short
+transaction, nothing is deleted row by row.
+
+    flask notification-partitions
+    flask archive-notifications
+"""
+import datetime
+import gzip
+import os
+import re
+from versions import app
+from versions.v2.models import db
+
+PARENT = 'notifications'
+DEFAULT = 'notifications_default'
+NAME = re.compile(r'^notifications_(\d{4})_(\d{2})$')
+
+
+def month_start(day):
+    """First day of the month of day"""
+    return datetime.date(day.year, day.month, 1)
+
+
+def next_month(month):
+    if month.month == 12:
+        return datetime.date(month.year + 1, 1, 1)
+    return datetime.date(month.year, month.month + 1, 1)
+
+
+def partition_name(month):
+    return '{}_{:04d}_{:02d}'.format(PARENT, month.year, month.month)
+
+
+def attached():
+    """{month: partition name} of the partitions of notifications"""
+    rows = db.session.execute(db.text(
+        'SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = CAST(:parent AS regclass)'
+    ), {'parent': PARENT})
+    months = {}
+    for (name,) in rows:
+        match = NAME.match(name)
+        if match:
+            months[datetime.date(
+                int(match.group(1)), int(match.group(2)), 1)] = name
+    return months
+
+
+def create_ahead(months_ahead, today=None):
+    """Create the partitions of this month and months_ahead more
+    returns the names of those created
+    """
+    existing = attached()
+    month = month_start(today or datetime.date.today())
+    created = []
+    for _ in range(months_ahead + 1):
+        if month not in existing:
+            create(month)
+            created.append(partition_name(month))
+        month = next_month(month)
+    return created
+
+
+def create(month):
+    """Partition of month, taking over its rows from the default one
+    a partition cannot be added while the default holds rows of its range
+    so the rows are moved into a plain table that is then attached, all in
+    one transaction
+    """
+    name = partition_name(month)
+    bounds = {'start': month, 'end': next_month(month)}
+    db.session.execute(db.text(
+        'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+        .format(name, PARENT)))
+    db.session.execute(db.text(
+        'WITH moved AS (DELETE FROM {} '
+        'WHERE window_start >= :start AND window_start < :end RETURNING *) '
+        'INSERT INTO {} SELECT * FROM moved'.format(DEFAULT, name)), bounds)
+    db.session.execute(db.text(
+        "ALTER TABLE {} ATTACH PARTITION {} "
+        "FOR VALUES FROM ('{}') TO ('{}')".format(
+            PARENT, name, bounds['start'], bounds['end'])))
+    db.session.commit()
+
+
+def fully_read(name):
+    """True when no notification of partition name is unread"""
+    return not db.session.execute(db.text(
+        'SELECT EXISTS (SELECT 1 FROM {} WHERE read_at IS NULL)'.format(name)
+    )).scalar()
+
+
+def export(name, directory):
+    """Copy partition name to <directory>/<name>.csv.gz, returns the path
+    written under a temporary name first so a half written file is never
+    taken for an archive
+    """
+    path = os.path.join(directory, '{}.csv.gz'.format(name))
+    connection = db.engine.raw_connection()
+    try:
+        with gzip.open(path + '.part', 'wb') as archive:
+            connection.cursor().copy_expert(
+                'COPY {} TO STDOUT WITH CSV HEADER'.format(name), archive)
+        connection.commit()
+    finally:
+        connection.close()
+    os.rename(path + '.part', path)
+    return path
+
+
+def archive(retention_days, directory, today=None):
+    """Archive and drop the partitions of months ended more than
+    retention_days ago whose notifications are all read
+    returns {partition name: archive path}
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    cutoff = (today or datetime.date.today()) - datetime.timedelta(
+        days=retention_days)
+    archived = {}
+    for month, name in sorted(attached().items()):
+        if next_month(month) > cutoff:
+            break
+        if not fully_read(name):
+            continue
+        path = export(name, directory)
+        # notifications are only ever marked read, an old month checked
+        # fully read stays that way, no new row can land in it either
+        db.session.execute(db.text(
+            'ALTER TABLE {} DETACH PARTITION {}'.format(PARENT, name)))
+        db.session.execute(db.text('DROP TABLE {}'.format(name)))
+        db.session.commit()
+        archived[name] = path
+        app.logger.info('archived %s to %s', name, path)
+    db.session.commit()
+    return archived
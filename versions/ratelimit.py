@@ -0,0 +1,193 @@
+"""Sliding window throttling for the auth endpoints
+Every attempt is logged per key, a key is over its limit when it has
+`limit` attempts within the last `window` seconds.
+Keys are the client address plus fields of the request such as the
+username or email, so one attacker cannot spread work across accounts
+and one account cannot be hammered from many addresses.
+
+Behind a proxy the client address is taken from X-Forwarded-For, counting
+RATELIMIT_TRUSTED_PROXIES hops from the right. Addresses further left are
+written by the client and never trusted.
+
+Every RATELIMIT_SWEEP_INTERVAL seconds attempts older than the longest
+window are dropped for every key, keys that never come back included.
+
+RATELIMIT_STORAGE picks the backend
+    memory              per process, for a single worker
+    sqlite:///<path>    shared by every worker on the host
+"""
+import sqlite3
+import threading
+import time
+from collections import deque
+from functools import wraps
+from flask import jsonify, request
+
+
+class MemoryBackend(object):
+    """Attempt log held in this process"""
+
+    def __init__(self):
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        """Log an attempt unless the key is over its limit
+        returns 0 when allowed else seconds until a slot frees
+        """
+        with self._lock:
+            log = self._attempts.setdefault(key, deque())
+            while log and log[0] <= now - window:
+                log.popleft()
+            if len(log) >= limit:
+                return log[0] + window - now
+            log.append(now)
+            return 0
+
+    def sweep(self, horizon, now):
+        """Forget keys whose newest attempt is older than horizon seconds"""
+        with self._lock:
+            for key in [key for key, log in self._attempts.items()
+                        if not log or log[-1] <= now - horizon]:
+                del self._attempts[key]
+
+    def reset(self):
+        with self._lock:
+            self._attempts.clear()
+
+
+class SQLiteBackend(object):
+    """Attempt log in a sqlite file shared by the workers of a host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS attempts (key TEXT, at REAL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_attempts_key_at '
+                'ON attempts (key, at)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_attempts_at ON attempts (at)')
+            self._local.connection = connection
+        return connection
+
+    def hit(self, key, limit, window, now):
+        """Same contract as MemoryBackend.hit, one write lock per call"""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'DELETE FROM attempts WHERE key = ? AND at <= ?',
+                (key, now - window))
+            count, oldest = connection.execute(
+                'SELECT count(*), min(at) FROM attempts WHERE key = ?',
+                (key,)).fetchone()
+            if count >= limit:
+                return oldest + window - now
+            connection.execute(
+                'INSERT INTO attempts (key, at) VALUES (?, ?)', (key, now))
+            return 0
+        finally:
+            connection.execute('COMMIT')
+
+    def sweep(self, horizon, now):
+        """Delete attempts older than horizon seconds of every key"""
+        self._connection().execute(
+            'DELETE FROM attempts WHERE at <= ?', (now - horizon,))
+
+    def reset(self):
+        connection = self._connection()
+        connection.execute('DELETE FROM attempts')
+
+
+class RateLimiter(object):
+    """Applies RATELIMITS from the config to decorated views"""
+
+    def __init__(self, app):
+        self.app = app
+        self.allowed = 0
+        self.rejected = 0
+        self._backend = None
+        self._swept = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            storage = self.app.config['RATELIMIT_STORAGE']
+            if storage.startswith('sqlite:///'):
+                self._backend = SQLiteBackend(storage[len('sqlite:///'):])
+            else:
+                self._backend = MemoryBackend()
+        return self._backend
+
+    def client_address(self):
+        """Address of the client as seen by the first trusted proxy"""
+        proxies = self.app.config['RATELIMIT_TRUSTED_PROXIES']
+        if not proxies:
+            return request.remote_addr
+        # access_route is X-Forwarded-For, or remote_addr without one
+        route = request.access_route
+        return route[-min(proxies, len(route))]
+
+    def sweep(self, now):
+        """Drop attempts that left the longest window"""
+        config = self.app.config
+        windows = [config['RATELIMIT_PER_IP'][1]]
+        windows.extend(window for _, window in config['RATELIMITS'].values())
+        self._swept = now
+        self.backend.sweep(max(windows), now)
+
+    def retry_after(self, scope, values):
+        """Log an attempt on every key, seconds to wait when one is over"""
+        config = self.app.config
+        now = time.time()
+        if now - self._swept >= config['RATELIMIT_SWEEP_INTERVAL']:
+            self.sweep(now)
+        checks = [('ip:{}'.format(self.client_address()),
+                   config['RATELIMIT_PER_IP'])]
+        checks.extend(
+            ('{}:{}'.format(scope, value.lower()), config['RATELIMITS'][scope])
+            for value in values if value
+        )
+        for key, (limit, window) in checks:
+            wait = self.backend.hit(key, limit, window, now)
+            if wait:
+                self.rejected += 1
+                return wait
+        self.allowed += 1
+        return 0
+
+    def limit(self, scope, json_fields=(), query_fields=()):
+        """Throttle a view before it runs
+        fields name the request values used as keys besides the client ip
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrap(*args, **kwargs):
+                if self.app.config['RATELIMIT_ENABLED']:
+                    data = request.get_json(silent=True)
+                    data = data if isinstance(data, dict) else {}
+                    values = [str(data.get(field) or '')
+                              for field in json_fields]
+                    values.extend(request.args.get(field, '')
+                                  for field in query_fields)
+                    wait = self.retry_after(scope, values)
+                    if wait:
+                        response = jsonify({
+                            'warning': 'Too many attempts, try again later'
+                        })
+                        response.headers['Retry-After'] = str(int(wait) + 1)
+                        return response, 429
+                return f(*args, **kwargs)
+            return wrap
+        return decorator
+
+    def stats(self):
+        return {'allowed': self.allowed, 'rejected': self.rejected}
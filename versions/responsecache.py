@@ -0,0 +1,257 @@
+"""Cached responses of read endpoints
+A cached view is answered from a local LRU tier first, then from a shared
+tier, and only runs when both miss.
+
+Entries are tagged, e.g. 'business:4', and every tag has a version number
+held by the shared tier. Entries are stored under their path plus the
+versions of their tags, so bumping a version makes every entry carrying
+that tag unreachable at once and leaves it to age out.
+
+RESPONSE_CACHE_STORAGE picks the shared tier
+    memory              none, tag versions are kept by this process, the
+                        cache is off when WEB_CONCURRENCY runs more than
+                        one worker since a write would go unseen by the rest
+    sqlite:///<path>    shared by every worker on the host
+    postgres            tag versions in the cache_tags table, seen by every
+                        worker of every host, entries stay local
+"""
+import json
+import sqlite3
+import threading
+import time
+from functools import wraps
+from flask import request
+from versions.cache import LRUCache
+
+# kept with an entry so cached responses can still be revalidated
+STORED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control')
+
+
+def business_tag(business_id):
+    """Tag of a business and its reviews
+    route values are read as numbers, /businesses/07 is tagged like 7
+    """
+    try:
+        business_id = int(business_id)
+    except (TypeError, ValueError):
+        pass
+    return 'business:{}'.format(business_id)
+
+
+class MemoryTier(object):
+    """No shared entries, tag versions local to this process
+    the interface a shared tier implements
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def versions(self, tags):
+        """Current version of each tag, 0 for tags never bumped"""
+        return [self._versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        """New version for each tag"""
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def get(self, key):
+        """Entry stored under key or None"""
+        return None
+
+    def set(self, key, value, expires_at):
+        """Store an entry until expires_at (unix time)"""
+
+    def clear(self):
+        with self._lock:
+            self._versions.clear()
+
+
+class SQLiteTier(object):
+    """Entries and tag versions in a sqlite file shared by the workers"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS tags '
+                '(tag TEXT PRIMARY KEY, version INTEGER)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries '
+                '(key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+            self._local.connection = connection
+        return connection
+
+    def versions(self, tags):
+        found = dict(self._connection().execute(
+            'SELECT tag, version FROM tags WHERE tag IN ({})'.format(
+                ', '.join('?' * len(tags))), tags).fetchall())
+        return [found.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for tag in tags:
+                connection.execute(
+                    'INSERT OR IGNORE INTO tags (tag, version) VALUES (?, 0)',
+                    (tag,))
+                connection.execute(
+                    'UPDATE tags SET version = version + 1 WHERE tag = ?',
+                    (tag,))
+        finally:
+            connection.execute('COMMIT')
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM entries WHERE key = ? AND expires_at > ?',
+            (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, expires_at):
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO entries (key, value, expires_at) '
+            'VALUES (?, ?, ?)', (key, json.dumps(value), expires_at))
+        # expired entries are dropped as new ones come in
+        connection.execute(
+            'DELETE FROM entries WHERE expires_at <= ?', (time.time(),))
+
+    def clear(self):
+        connection = self._connection()
+        connection.execute('DELETE FROM entries')
+        connection.execute('DELETE FROM tags')
+
+
+class PostgresTier(MemoryTier):
+    """Tag versions in the database, no shared entries
+    one primary key lookup per cached read
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def versions(self, tags):
+        found = dict(self.db.engine.execute(self.db.text(
+            'SELECT tag, version FROM cache_tags WHERE tag IN :tags'
+        ).bindparams(self.db.bindparam('tags', expanding=True)),
+            tags=list(tags)).fetchall())
+        return [found.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        self.db.engine.execute(self.db.text(
+            'INSERT INTO cache_tags (tag, version) VALUES (:tag, 1) '
+            'ON CONFLICT (tag) DO UPDATE SET version = cache_tags.version + 1'
+        ), [{'tag': tag} for tag in tags])
+
+    def clear(self):
+        self.db.engine.execute(self.db.text('DELETE FROM cache_tags'))
+
+
+class ResponseCache(object):
+    """Caches 200 responses of decorated views for RESPONSE_CACHE_TTL"""
+
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+        self.local = LRUCache(app.config['RESPONSE_CACHE_SIZE'])
+        self.shared_hits = 0
+        self.invalidations = 0
+        self._shared = None
+
+    @property
+    def shared(self):
+        if self._shared is None:
+            storage = self.app.config['RESPONSE_CACHE_STORAGE']
+            if storage.startswith('sqlite:///'):
+                self._shared = SQLiteTier(storage[len('sqlite:///'):])
+            elif storage == 'postgres':
+                self._shared = PostgresTier(self.db)
+            else:
+                self._shared = MemoryTier()
+        return self._shared
+
+    @property
+    def enabled(self):
+        """RESPONSE_CACHE_ENABLED, unless tag versions would be held by
+        one of several worker processes
+        """
+        config = self.app.config
+        return config['RESPONSE_CACHE_ENABLED'] and not (
+            type(self.shared) is MemoryTier and
+            config['WEB_CONCURRENCY'] > 1)
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying one of tags"""
+        self.shared.bump(tags)
+        self.invalidations += 1
+
+    def cached(self, tags):
+        """Serve a view from the cache
+        tags is called with the view arguments and names the tags of its
+        response
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrap(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+
+                entry_tags = list(tags(**kwargs))
+                key = '{}|{}'.format(request.full_path, ','.join(
+                    '{}={}'.format(tag, version) for tag, version in
+                    zip(entry_tags, self.shared.versions(entry_tags))))
+
+                entry = self.local.get(key)
+                if entry is None:
+                    entry = self.shared.get(key)
+                    if entry is not None:
+                        self.shared_hits += 1
+                        self.local.set(
+                            key, entry, expires_at=entry['expires_at'])
+                if entry is not None:
+                    response = self.app.response_class(
+                        entry['body'], status=200,
+                        mimetype=entry['mimetype'],
+                        headers=entry.get('headers'))
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                response = self.app.make_response(f(*args, **kwargs))
+                if response.status_code == 200:
+                    entry = {
+                        'body': response.get_data(as_text=True),
+                        'mimetype': response.mimetype,
+                        'headers': dict(
+                            (name, response.headers[name])
+                            for name in STORED_HEADERS
+                            if name in response.headers),
+                        'expires_at':
+                        time.time() + self.app.config['RESPONSE_CACHE_TTL']
+                    }
+                    self.local.set(
+                        key, entry, expires_at=entry['expires_at'])
+                    self.shared.set(key, entry, entry['expires_at'])
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrap
+        return decorator
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+    def stats(self):
+        """Counters of this process, hits and misses of the local tier"""
+        stats = self.local.stats()
+        stats['shared_hits'] = self.shared_hits
+        stats['invalidations'] = self.invalidations
+        return stats
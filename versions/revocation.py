@@ -0,0 +1,161 @@
+"""Host-wide cache of revoked token digests
+A Bloom filter kept in a memory mapped file so every gunicorn worker
+on the host reads and writes the same bits.
+
+A negative answer is definite, the token was never revoked and
+login_required can skip the authtokens lookup.
+A positive answer may be a false positive so it falls through to the db.
+
+Revocations are retired by generation. The file holds two filters and
+the number of the current generation, one generation lasts as long as an
+access token. Digests are added to the current filter and looked up in
+both, the first access in a new generation clears the older filter and
+makes it current. A digest is thus kept at least one token lifetime, by
+which time the token has expired, and the false positive rate follows
+the revocations of the last two lifetimes instead of every one made.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+# current generation, ahead of the two filters
+HEADER = struct.Struct('>Q')
+
+
+def token_digest(token):
+    """Fixed width sha256 hex digest of a raw token"""
+    if isinstance(token, str):
+        token = token.encode('UTF-8')
+    return hashlib.sha256(token).hexdigest()
+
+
+class RevocationCache(object):
+    """Bloom filter of revoked token digests backed by a shared file"""
+
+    def __init__(self, path, size_bits, hashes, lifetime):
+        self.path = path
+        self.size_bits = size_bits
+        self.hashes = hashes
+        self.lifetime = lifetime
+        self.hits = 0
+        self.misses = 0
+        self.rotations = 0
+        self._map = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Map the filter file, (re)created when its size does not match
+        mapping is per process so it is redone after a fork
+        """
+        if self._map is not None and self._pid == os.getpid():
+            return self._map
+
+        size = HEADER.size + 2 * (self.size_bits // 8)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._pid = os.getpid()
+        return self._map
+
+    def _positions(self, digest):
+        """Double hashing over the two leading 64 bit words of the digest"""
+        first, second = struct.unpack('>QQ', bytes.fromhex(digest[:32]))
+        second |= 1
+        return [(first + i * second) % self.size_bits
+                for i in range(self.hashes)]
+
+    def _generation(self, now=None):
+        return int((time.time() if now is None else now) // self.lifetime)
+
+    def _filter(self, generation):
+        """Byte offset of the filter of generation"""
+        return HEADER.size + (generation % 2) * (self.size_bits // 8)
+
+    def _rotate(self, bits, generation):
+        """Make generation current, clearing what is older than the one
+        before it, called under the file lock
+        """
+        current = HEADER.unpack_from(bits, 0)[0]
+        if current >= generation:
+            return
+        length = self.size_bits // 8
+        stale = [generation] if generation - current == 1 else [
+            generation, generation - 1]
+        for number in stale:
+            start = self._filter(number)
+            bits[start:start + length] = bytes(length)
+        HEADER.pack_into(bits, 0, generation)
+        self.rotations += 1
+
+    def add(self, digest, now=None):
+        """Mark a digest as revoked for every worker on the host"""
+        self.add_many([digest], now)
+
+    def add_many(self, digests, now=None):
+        """Set the bits for several digests under one file lock"""
+        bits = self._open()
+        generation = self._generation(now)
+        with self._lock, open(self.path, 'rb') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                self._rotate(bits, generation)
+                start = self._filter(generation)
+                for digest in digests:
+                    for position in self._positions(digest):
+                        index = start + (position >> 3)
+                        bits[index] = bits[index] | (1 << (position & 7))
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def might_be_revoked(self, digest, now=None):
+        """False means the token is definitely not revoked"""
+        bits = self._open()
+        generation = self._generation(now)
+        if HEADER.unpack_from(bits, 0)[0] < generation:
+            with self._lock, open(self.path, 'rb') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                try:
+                    self._rotate(bits, generation)
+                finally:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+        positions = self._positions(digest)
+        for number in [generation, generation - 1]:
+            start = self._filter(number)
+            if all(bits[start + (position >> 3)] & (1 << (position & 7))
+                   for position in positions):
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def rebuild(self, digests):
+        """Fold every digest revoked in the db and not yet expired into the
+        current filter
+        bits are only ever set here, never cleared, so a worker starting
+        up cannot drop a revocation made by another worker meanwhile
+        """
+        self.add_many(digests)
+
+    def stats(self):
+        """Hit and miss counters of this process"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'size_bits': self.size_bits,
+            'hashes': self.hashes,
+            'rotations': self.rotations
+        }
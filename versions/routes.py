@@ -1,11 +1,29 @@
-from versions import app
-from flask import render_template, jsonify
+import hmac
+from versions import app, metrics
+from versions.hashing import HashingPoolBusy
+from versions.pagination import InvalidCursor
+from flask import abort, render_template, jsonify, request
 
 @app.route('/')
 def version2():
     """route for API documentation"""
     return render_template('version2.html')
 
+@app.route('/metrics')
+def read_metrics():
+    """Counters of the caches and pools in this worker
+    with METRICS_TOKEN set only requests sending it as X-Metrics-Token
+    are answered, without one only if METRICS_PUBLIC
+    """
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(
+                request.headers.get('X-Metrics-Token', ''), token):
+            abort(404)
+    elif not app.config['METRICS_PUBLIC']:
+        abort(404)
+    return jsonify(metrics.snapshot()), 200
+
 @app.errorhandler(404)
 def page_not_found(e):
     return jsonify({'warning': '404, Endpoint not found'}), 404
@@ -13,3 +31,13 @@ def page_not_found(e):
 @app.errorhandler(500)
 def internal_server_error(e):
     return jsonify({'warning': '500, Internal Server Error'}), 500
+
+@app.errorhandler(HashingPoolBusy)
+def hashing_pool_busy(e):
+    response = jsonify({'warning': '503, Server busy, try again shortly'})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+@app.errorhandler(InvalidCursor)
+def invalid_cursor(e):
+    return jsonify({'warning': 'Invalid cursor'}), 400
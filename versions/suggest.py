@@ -0,0 +1,127 @@
+"""Business name suggestions
+PrefixIndex keeps the normalized names of this process in one sorted list
+so a keystroke is answered with a bisect instead of a database query.
+Every word of a name starts a key, "Crown Paints" is found by "cro" and
+by "pai". Writes made by this process are applied as they happen, those
+of other workers show up when the index is rebuilt.
+"""
+import bisect
+import sys
+import threading
+import time
+
+
+def normalize(value):
+    """lowercase with runs of whitespace collapsed"""
+    return ' '.join(value.casefold().split())
+
+
+def name_keys(name):
+    """keys a name is found by, one from each word on"""
+    words = normalize(name).split(' ')
+    return tuple(' '.join(words[i:]) for i in range(len(words)) if words[i])
+
+
+class PrefixIndex(object):
+    """Sorted (key, id) pairs with the display name of each id"""
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.built_at = None
+        self.built_bytes = 0
+        self.lookups = 0
+        self._keys = []
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def build(self, rows):
+        """Replace the index with (id, name) rows, returns its size in bytes"""
+        names = {}
+        keys = []
+        for row_id, name in rows:
+            entry_keys = name_keys(name)
+            names[row_id] = (name, entry_keys)
+            keys.extend((key, row_id) for key in entry_keys)
+        keys.sort()
+        with self._lock:
+            self._keys = keys
+            self._names = names
+            self.built_at = time.time()
+        self.built_bytes = self.memory()
+        return self.built_bytes
+
+    def stale(self):
+        """True before the first build or once max_age has passed"""
+        return self.built_at is None or \
+            time.time() - self.built_at > self.max_age
+
+    def upsert(self, row_id, name):
+        """Index name under row_id, dropping any name it had before
+        a missing or blank name leaves row_id out of the index
+        """
+        with self._lock:
+            self._remove(row_id)
+            if not name or not name.strip():
+                return
+            entry_keys = name_keys(name)
+            self._names[row_id] = (name, entry_keys)
+            for key in entry_keys:
+                bisect.insort(self._keys, (key, row_id))
+
+    def discard(self, row_id):
+        """Drop row_id if indexed"""
+        with self._lock:
+            self._remove(row_id)
+
+    def _remove(self, row_id):
+        entry = self._names.pop(row_id, None)
+        if entry is None:
+            return
+        for key in entry[1]:
+            position = bisect.bisect_left(self._keys, (key, row_id))
+            if position < len(self._keys) and \
+                    self._keys[position] == (key, row_id):
+                del self._keys[position]
+
+    def search(self, prefix, limit):
+        """Up to limit (id, name) pairs with a key starting with prefix"""
+        prefix = normalize(prefix)
+        self.lookups += 1
+        if not prefix:
+            return []
+        matches = []
+        seen = set()
+        with self._lock:
+            position = bisect.bisect_left(self._keys, (prefix,))
+            while position < len(self._keys) and len(matches) < limit:
+                key, row_id = self._keys[position]
+                if not key.startswith(prefix):
+                    break
+                if row_id not in seen:
+                    seen.add(row_id)
+                    matches.append((row_id, self._names[row_id][0]))
+                position += 1
+        return matches
+
+    def memory(self):
+        """Approximate bytes held by the index"""
+        with self._lock:
+            size = sys.getsizeof(self._keys) + sys.getsizeof(self._names)
+            for pair in self._keys:
+                size += sys.getsizeof(pair) + sys.getsizeof(pair[0])
+            for name, entry_keys in self._names.values():
+                size += sys.getsizeof(name) + sys.getsizeof(entry_keys)
+        return size
+
+    def __len__(self):
+        return len(self._names)
+
+    def stats(self):
+        """Counters of this process"""
+        return {
+            'names': len(self._names),
+            'keys': len(self._keys),
+            'lookups': self.lookups,
+            'built_at': self.built_at,
+            'built_bytes': self.built_bytes
+        }
@@ -1,8 +1,9 @@
+import json
 import re
 from flask_mail import Message
-from flask import jsonify, render_template
-from versions import mail
-from versions.v2.models import Business, db, User
+from flask import jsonify, request
+from versions import app, email_templates
+from versions.v2.models import Business, db, Outbox, User
 
 def check_keys(args, length):
     """Check if dict keys are provided
@@ -51,50 +52,64 @@ def validate(data):
 
 
 # Send Mail
+# emails are written to the outbox within the caller's transaction
+# and delivered by `flask outbox-worker`, see versions/outbox.py
+def queue_email(subject, recipients, template, **context):
+    """Add an email to the outbox, committed along with the caller's changes
+    the request root is kept so links render the same in the worker
+    """
+    context['_base_url'] = request.url_root
+    db.session.add(Outbox(
+        subject=subject,
+        recipients=recipients,
+        template=template,
+        context=json.dumps(context)
+    ))
+
+
+def build_message(outbox):
+    """Render an outbox row into a Message ready to send"""
+    context = json.loads(outbox.context)
+    # popped by hand, `with` keeps the context of a failed render around
+    # when PRESERVE_CONTEXT_ON_EXCEPTION is on
+    request_context = app.test_request_context(
+        base_url=context.pop('_base_url'))
+    request_context.push()
+    try:
+        msg = Message(
+            outbox.subject,
+            sender='victormutaijambo@gmail.com',
+            recipients=outbox.recipients.split(',')
+        )
+        msg.html = email_templates.render(outbox.template, context)
+    finally:
+        request_context.pop()
+    return msg
+
+
 def send_email(recipients, hash_key, username, path):
     """Send email activation
     https://blog.miguelgrinberg.com/post/the-flask-mega-tutorial-part-xi-email-support
     """
-    msg = Message(
-        'Verify Account',
-        sender='victormutaijambo@gmail.com',
-        recipients=recipients
-    )
-    msg.html = render_template(
-        'email.html', hash_key=hash_key, name=username, path=path)
-    mail.send(msg)
+    queue_email(
+        'Verify Account', recipients, 'email.html',
+        hash_key=hash_key, name=username, path=path)
 
 
 def send_forgot_password_email(recipients, new_password):
     """Send email with new password
     """
-    msg = Message(
-        'Forgot Password',
-        sender='victormutaijambo@gmail.com',
-        recipients=recipients
-    )
-    msg.html = render_template(
-        'forgotemail.html',
-        new_password=new_password
-    )
-    mail.send(msg)
+    queue_email(
+        'Forgot Password', recipients, 'forgotemail.html',
+        new_password=new_password)
 
 
 def send_confirm_reset_password_email(recipients, hash_key, name, path):
     """Send email with to reset password
     """
-    msg = Message(
-        'Reset Password',
-        sender='victormutaijambo@gmail.com',
-        recipients=recipients
-    )
-    msg.html = render_template(
-        'resetpasswordemail.html',
-        hash_key=hash_key,
-        name=name,
-        path=path
-    )
-    mail.send(msg)
+    queue_email(
+        'Reset Password', recipients, 'resetpasswordemail.html',
+        hash_key=hash_key, name=name, path=path)
 
 
 def existing_module(module, name):
@@ -106,6 +121,18 @@ def existing_module(module, name):
     return False
 
 
+def conflicting_field(error, fields):
+    """First of fields named by the unique constraint an IntegrityError broke
+    psycopg2 reports the constraint name, other drivers only a message
+    """
+    diag = getattr(error.orig, 'diag', None)
+    detail = getattr(diag, 'constraint_name', None) or str(error.orig)
+    for field in fields:
+        if field in detail:
+            return field
+    return None
+
+
 def get_in_module(module, businessId):
     modules = { 'user': User, 'business': Business }
     return modules[module].query.get(businessId)
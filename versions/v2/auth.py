@@ -16,6 +16,10 @@ PUT: reset user password
     compares password
 DELETE: logout
     clear user session
+    revokes every refresh token of the session
+POST: refresh
+    exchanges a refresh token for a new access token
+    rotates the refresh token, reuse revokes the whole family
 POST: forgot password
     Check if email provided exists
     reset user password
@@ -25,14 +29,17 @@ GET: verify/Activate email
 app.url_map
 """
 from flask import Blueprint, jsonify, request, session, redirect
-from versions.v2.models import User, db, AuthToken
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from versions.v2.models import User, db, AuthToken, RefreshToken
 from versions.utils import check_keys, send_email, send_forgot_password_email, send_confirm_reset_password_email
+from versions.utils import conflicting_field
 from versions.utils import username_regex, email_regex, password_regex
-from passlib.hash import sha256_crypt
 import datetime
 from functools import wraps
 import os
-from versions import login_required
+from versions import decoded_tokens, hashing_pool, limiter, login_required
+from versions import revoked_tokens, token_digest
 import jwt
 import uuid
 
@@ -40,8 +47,40 @@ import uuid
 mod = Blueprint('auth_v2', __name__)
 
 
+def issue_tokens(user, family):
+    """Creates an access token and the next refresh token of a family
+    both are added to the session, the caller commits
+    """
+    now = datetime.datetime.utcnow()
+    exp_time = now + datetime.timedelta(
+        minutes=current_app.config['ACCESS_TOKEN_MINUTES'])
+    token = jwt.encode(
+        {
+            'id': user.id,
+            'username': user.username,
+            'activate': user.activate,
+            'fam': family,
+            'jti': uuid.uuid4().hex,
+            'exp': exp_time
+        }, os.getenv("SECRET")
+    ).decode('UTF-8')
+    db.session.add(AuthToken(token, exp_time))
+
+    refresh_token = RefreshToken.generate()
+    db.session.add(RefreshToken(
+        refresh_token,
+        family,
+        user.id,
+        now + datetime.timedelta(
+            days=current_app.config['REFRESH_TOKEN_DAYS'])
+    ))
+    return token, refresh_token
+
+
 def validations(f):
     """Runs validation checks for fields provided before save
+    taken usernames and emails are caught by the unique constraints
+    when the user is inserted
     """
     @wraps(f)
     def wrap(*args, **kwargs):
@@ -53,18 +92,6 @@ def validations(f):
                 'warning': 'All Fields Required'
             }), 400
 
-        # check if username is taken
-        if db.session.query(
-            db.exists().where(User.username == data['username'])
-        ).scalar():
-            return jsonify({'warning': 'Username has already been taken'}), 409
-
-        # check if email is taken
-        if db.session.query(
-            db.exists().where(User.email == data['email'])
-        ).scalar():
-            return jsonify({'warning': 'Email has already been taken'}), 409
-
         # validate username
         if not username_regex.match(data['username'].lower()):
             return jsonify({
@@ -117,15 +144,25 @@ def signup():
         password=data['password']
     )
 
-    # Commits new user instance to db
-    new_user.save()
+    # Commits new user instance to db along with the activation email
+    send_email(
+        [new_user.email],
+        new_user.hash_key,
+        new_user.username,
+        'auth_v2'
+    )
+    try:
+        new_user.save()
+    except IntegrityError as error:
+        db.session.rollback()
+        taken = conflicting_field(error, ['username', 'email'])
+        if not taken:
+            raise
+        return jsonify({
+            'warning': '{} has already been taken'.format(taken.capitalize())
+        }), 409
+
     if new_user.id:
-        send_email(
-            [new_user.email],
-            new_user.hash_key,
-            new_user.username,
-            'auth_v2'
-        )
         return jsonify({'success': {
             'id': new_user.id,
             'username': new_user.username,
@@ -139,6 +176,7 @@ def signup():
 
 
 @mod.route('/login', methods=['POST'])
+@limiter.limit('login', json_fields=['username'])
 def login():
     """Login registered user"""
     auth = request.get_json()
@@ -157,22 +195,23 @@ def login():
     password = user.password
     candidate_password = auth['password']
 
-    if sha256_crypt.verify(candidate_password, password):
+    is_valid, upgraded_password = hashing_pool.verify_and_update(
+        candidate_password, password)
+
+    if is_valid:
         # Sha256 decodes and compares passwords
         # then creates a token that expires in 30 min
+        # and starts a new family of refresh tokens
+        # hashes below the configured cost are replaced on the way
+        if upgraded_password:
+            user.password = upgraded_password
         session['logged_in'] = True
         session['username'] = auth['username']
-        exp_time = datetime.datetime.utcnow() + datetime.timedelta(minutes=30)
-        token = jwt.encode(
-            {
-                'id': user.id,
-                'username': user.username,
-                'exp': exp_time
-            }, os.getenv("SECRET")
-        )
-        AuthToken(token.decode('UTF-8')).save()
+        token, refresh_token = issue_tokens(user, uuid.uuid4().hex)
+        db.session.commit()
         return jsonify({
-            'token': token.decode('UTF-8'),
+            'token': token,
+            'refresh_token': refresh_token,
             'success': 'Login success'
         }), 200
 
@@ -186,23 +225,24 @@ def reset_password(current_user):
     """Update user password
     User should be logged in first to update
     """
-    if not current_user:
+    if not current_user.id:
         return jsonify({'warning': 'Login Again'}), 401
 
     data = request.get_json()
 
-    user = User.query.get(current_user)
+    user = User.query.get(current_user.id)
 
-    if sha256_crypt.verify(data['old_password'], user.password):
-        user.password = sha256_crypt.encrypt(str(data['password']))
-        user.save()
+    if hashing_pool.verify(data['old_password'], user.password):
+        user.password = hashing_pool.hash(data['password'])
         send_confirm_reset_password_email([user.email], user.hash_key, user.username, os.getenv("DESTINATION_URL"))
+        user.save()
         return jsonify({'success': 'password updated'}), 200
 
     return jsonify({'warning': 'old password does not match'}), 403
 
 
 @mod.route("/forgot-password", methods=['POST'])
+@limiter.limit('forgot-password', json_fields=['email'])
 def forgot_password():
     """Sends new password to your mail"""
     data = request.get_json()
@@ -212,9 +252,9 @@ def forgot_password():
     # check if email is taken
     if data['email'] and user:
         new_password = uuid.uuid4().hex.upper()[0:6]
-        user.password = sha256_crypt.encrypt(new_password)
-        user.save()
+        user.password = hashing_pool.hash(new_password)
         send_forgot_password_email([data['email']], new_password)
+        user.save()
         return jsonify({'success': 'Email has been sent with new password'}), 200
 
     return jsonify({'warning': 'No user exists with that email'}), 409
@@ -225,14 +265,50 @@ def forgot_password():
 def logout(current_user):
     """Destroy user session"""
     token_from_request = request.headers['x-access-token']
-    instance_tokens = AuthToken.query.filter_by(token=token_from_request).first()
+    instance_tokens = AuthToken.find(token_from_request)
     if instance_tokens:
         instance_tokens.valid = False
+        if current_user.family:
+            RefreshToken.revoke_family(current_user.family)
         instance_tokens.save()
+        revoked_tokens.add(token_digest(token_from_request))
+        decoded_tokens.pop(token_digest(token_from_request))
         return jsonify({'success': 'logged out'}), 200
     return jsonify({'message': 'Invalid token!'}), 401
 
 
+@mod.route('/refresh', methods=['POST'])
+def refresh():
+    """Exchange a refresh token for a new access token
+    password is not checked, the refresh token is rotated on use
+    presenting a used token again revokes its whole family
+    """
+    data = request.get_json() or {}
+    stored = RefreshToken.find(str(data.get('refresh_token')))
+
+    if not stored or stored.revoked or \
+            stored.expires_at < datetime.datetime.utcnow():
+        return jsonify({
+            'warning': 'Invalid refresh token. Please login'
+        }), 401
+
+    if not RefreshToken.claim(stored.id):
+        RefreshToken.revoke_family(stored.family)
+        db.session.commit()
+        return jsonify({
+            'warning': 'Invalid refresh token. Please login'
+        }), 401
+
+    user = User.query.get(stored.user_id)
+    token, refresh_token = issue_tokens(user, stored.family)
+    db.session.commit()
+    return jsonify({
+        'token': token,
+        'refresh_token': refresh_token,
+        'success': 'Token refreshed'
+    }), 200
+
+
 @mod.route("/verify")
 def verify():
     """Verify email activation"""
@@ -246,6 +322,7 @@ def verify():
 
 
 @mod.route("/confirm-reset-password/", methods=['POST'])
+@limiter.limit('confirm-reset-password', query_fields=['name'])
 def confirm_reset_password():
     """Verify email activation"""
     hash_key = request.args.get('key', type=str)
@@ -254,7 +331,7 @@ def confirm_reset_password():
     if hash_key and name:
         user = User.query.filter_by(username=name).first()
         if user.hash_key == hash_key:
-            user.password = sha256_crypt.encrypt(str(data['password']))
+            user.password = hashing_pool.hash(data['password'])
             user.save()
             return jsonify({'success': 'password changed'}), 200
     return jsonify({'warning': 'Invalid token URL!'}), 401
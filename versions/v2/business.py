@@ -8,16 +8,41 @@ GET: Read single business info
 PUT: Updates single business
 DELETE: Delete single business
 """
+import time
 from flask import Blueprint, jsonify, request
-from versions.v2.models import Business
-from versions import login_required
+from sqlalchemy.exc import IntegrityError
+from versions.v2.models import Business, db
+from versions import app, business_names, login_required, response_cache
+from versions.responsecache import business_tag
 from functools import wraps
-from versions.utils import existing_module, get_in_module
+from versions.conditional import conditional, if_match_version, validate
+from versions.conditional import version_etag
+from versions.utils import conflicting_field, existing_module, get_in_module
+from versions.pagination import TOTAL_MODES, clamp_limit, decode_cursor
 
 
 mod = Blueprint('business_v2', __name__)
 
 
+def name_taken(error, name):
+    """409 response when an IntegrityError came from the unique name"""
+    db.session.rollback()
+    if not conflicting_field(error, ['name']):
+        raise error
+    return jsonify({
+        'warning': 'Business name {} already taken'.format(name)
+    }), 409
+
+
+def refusal(current_user, business):
+    """Response when current_user may not change business, else None"""
+    if not business:
+        return jsonify({'warning': 'Business Not Found'}), 404
+
+    if current_user.id != business.user_id:
+        return jsonify({'warning': 'Not Allowed, you are not owner'}), 401
+
+
 def precheck(f):
     """Checks if businessID is available
     Check if business belongs to current user
@@ -25,14 +50,7 @@ def precheck(f):
     @wraps(f)
     def wrap(*args, **kwargs):
         business = get_in_module('business', kwargs['businessId'])
-
-        if not business:
-            return jsonify({'warning': 'Business Not Found'}), 404
-
-        if args[0] != business.owner.id:
-            return jsonify({'warning': 'Not Allowed, you are not owner'}), 401
-
-        return f(*args, **kwargs)
+        return refusal(args[0], business) or f(*args, **kwargs)
     return wrap
 
 
@@ -40,20 +58,38 @@ def precheck(f):
 def read_all_businesses():
     """Reads all Businesses
     user can search for business via business name
-    response is paginated per limit
+    response is paginated per limit, at most MAX_PAGE_LIMIT
+    `next` is the cursor of the following page
+    ?total=exact or ?total=estimate adds the number of matches
+    ?match= picks how q matches: text (default) searches name, category
+    and bio, substring finds q within the name, fuzzy tolerates typos
+    in the name
     """
+    cursor = request.args.get('cursor', default=None, type=str)
+    total = request.args.get('total', default=None, type=str)
+    if total and total not in TOTAL_MODES:
+        return jsonify({'warning': 'total should be exact or estimate'}), 400
+    match = request.args.get('match', default='text', type=str)
+    if match not in Business.match_modes:
+        return jsonify({
+            'warning': 'match should be text, substring or fuzzy'}), 400
+
     params = {
-        'page': request.args.get('page', default=1, type=int),
-        'limit': request.args.get('limit', default=5, type=int),
+        'page': max(1, request.args.get('page', default=1, type=int)),
+        'limit': clamp_limit(request.args.get('limit', default=5, type=int)),
+        'cursor': decode_cursor(cursor) if cursor else None,
         'location': request.args.get('location', default=None, type=str),
         'category': request.args.get('category', default=None, type=str),
-        '_query': request.args.get('q', default=None, type=str)
+        '_query': request.args.get('q', default=None, type=str),
+        'match': match
     }
 
-    businesses = Business().Search(params)
+    businesses, next_cursor = Business().Search(
+        params, load=[db.joinedload(Business.owner)])
 
     if businesses:
-        return jsonify({
+        response = {
+            'next': next_cursor,
             'businesses': [
                 {   'id': business.id,
                     'name': business.name,
@@ -66,10 +102,48 @@ def read_all_businesses():
                     'updated_at': business.updated_at
                 } for business in businesses
             ]
-        }), 200
+        }
+        if total:
+            response['total'] = Business().total(params, total)
+        return jsonify(response), 200
     return jsonify({'warning': 'No Businesses, create one first'}), 200
 
 
+@app.before_first_request
+def load_business_names():
+    """Build the suggestion index from businesses
+    called again once the index is older than SUGGEST_INDEX_MAX_AGE to
+    pick up names written by other workers
+    """
+    started = time.time()
+    size = business_names.build(
+        db.session.query(Business.id, Business.name).filter(
+            Business.name != None))
+    app.logger.info(
+        'business name index: %d names, %d bytes, built in %.1fms',
+        len(business_names), size, (time.time() - started) * 1000)
+
+
+@mod.route('/suggest', methods=['GET'])
+def suggest_businesses():
+    """Suggests business names starting with q, for autocomplete
+    answered from the in-process prefix index, never the database
+    unless the index is due for a rebuild
+    """
+    if business_names.stale():
+        load_business_names()
+    limit = request.args.get(
+        'limit', default=app.config['SUGGEST_LIMIT'], type=int)
+    prefix = request.args.get('q', default='', type=str)
+    return jsonify({
+        'suggestions': [
+            {'id': business_id, 'name': name}
+            for business_id, name in business_names.search(
+                prefix, clamp_limit(limit))
+        ]
+    }), 200
+
+
 @mod.route('/', methods=['POST'])
 @login_required
 def create_business(current_user):
@@ -79,14 +153,6 @@ def create_business(current_user):
     """
     data = request.get_json()
 
-    # Check if there is an existing business with same name
-    if existing_module('business', data['name']):
-        return jsonify({
-            'warning': 'Business name {} already taken'.format(data['name'])
-        }), 409
-
-    business_owner = get_in_module('user', current_user)
-
     # create new business instances
     new_business = Business(
         name=data['name'],
@@ -94,11 +160,14 @@ def create_business(current_user):
         location=data['location'],
         category=data['category'],
         bio=data['bio'],
-        owner=business_owner
+        user_id=current_user.id
     )
 
-    # Commit changes to db
-    new_business.save()
+    # Commit changes to db, the unique index rejects a taken name
+    try:
+        new_business.save()
+    except IntegrityError as error:
+        return name_taken(error, data['name'])
 
     # Send response if business was saved
     if new_business.id:
@@ -110,7 +179,7 @@ def create_business(current_user):
                 'location': new_business.location,
                 'category': new_business.category,
                 'bio': new_business.bio,
-                'owner': new_business.owner.username
+                'owner': current_user.username
             }
         }), 201
 
@@ -118,12 +187,15 @@ def create_business(current_user):
 
 
 @mod.route('/<businessId>', methods=['GET'])
+@conditional
+@response_cache.cached(
+    lambda businessId: [business_tag(businessId)])
 def read_business(businessId):
     """Reads Business given a business id"""
     business = get_in_module('business', businessId)
 
     if business:
-        return jsonify({
+        response = jsonify({
             'business': {
                 'id': business.id,
                 'name': business.name,
@@ -132,48 +204,61 @@ def read_business(businessId):
                 'category': business.category,
                 'bio': business.bio,
                 'owner': business.owner.username,
+                'version': business.version,
                 'created_at': business.created_at,
                 'updated_at': business.updated_at
             }
-        }), 200
+        })
+        return validate(
+            response,
+            version_etag('business', business.id, business.version),
+            business.updated_at)
     return jsonify({'warning': 'Business Not Found'}), 404
 
 
 @mod.route('/<businessId>', methods=['PUT'])
 @login_required
-@precheck
 def update_business(current_user, businessId):
     """Updates a business given a business ID
-    confirms if current user is owner of business
+    one conditional UPDATE confirms current user is owner of business
+    and, when If-Match is sent, that nobody changed it since it was read
+    the business is only loaded to explain a refused update
     """
     data = request.get_json()
-    business = get_in_module('business', businessId)
-
-    business.name = data['name']
-    business.logo = data['logo']
-    business.location = data['location']
-    business.category = data['category']
-    business.bio = data['bio']
-
-    business.save()
-
-    if business.name == data['name']:
-        return jsonify({
-            'success': 'successfully updated',
-            'business': {
-                'id': business.id,
-                'name': business.name,
-                'logo': business.logo,
-                'location': business.location,
-                'category': business.category,
-                'bio': business.bio,
-                'owner': business.owner.username,
-                'created_at': business.created_at,
-                'updated_at': business.updated_at
-            }
-        }), 201
-
-    return jsonify({'warning': 'Business Not Updated'}), 400
+    values = dict(
+        (field, data[field])
+        for field in ['name', 'logo', 'location', 'category', 'bio'])
+
+    try:
+        business = Business.update_owned(
+            businessId, current_user.id, values,
+            if_match_version('business', businessId))
+    except IntegrityError as error:
+        return name_taken(error, data['name'])
+
+    if business is None:
+        return refusal(
+            current_user, get_in_module('business', businessId)) or (
+            jsonify({'warning': 'Business was changed, reload it'}), 412)
+
+    response = jsonify({
+        'success': 'successfully updated',
+        'business': {
+            'id': business.id,
+            'name': business.name,
+            'logo': business.logo,
+            'location': business.location,
+            'category': business.category,
+            'bio': business.bio,
+            'owner': current_user.username,
+            'version': business.version,
+            'created_at': business.created_at,
+            'updated_at': business.updated_at
+        }
+    })
+    response.set_etag(
+        version_etag('business', business.id, business.version))
+    return response, 201
 
 
 @mod.route('/<businessId>', methods=['DELETE'])
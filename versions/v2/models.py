@@ -1,6 +1,13 @@
+import binascii
+import datetime
+import os
 import uuid
-from versions import db
-from passlib.hash import sha256_crypt
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR, insert
+from versions import app, business_names, db, hashing_pool
+from versions import response_cache, token_digest
+from versions.responsecache import business_tag
+from versions.pagination import encode_cursor, estimated_count
+from versions.pagination import keyset_cursor, keyset_values, offset_value
 
 
 class User(db.Model):
@@ -51,7 +58,7 @@ class User(db.Model):
         self.username = username.lower().strip()
         self.fullname = fullname
         self.email = email.lower().strip()
-        self.password = sha256_crypt.encrypt(str(password))
+        self.password = hashing_pool.hash(password)
         self.hash_key = uuid.uuid1().hex
         self.activate = False
 
@@ -61,20 +68,64 @@ class User(db.Model):
         db.session.commit()
 
 
-class Business(db.Model):
+class Versioned(object):
+    """Optimistic concurrency for rows edited by their owner
+    version goes up by one on every update
+    """
+    version = db.Column(
+        db.Integer, nullable=False, default=1, server_default='1')
+
+    @classmethod
+    def update_owned(cls, row_id, user_id, values, version=None,
+                     returning=(), where=()):
+        """Apply values in one conditional UPDATE ... RETURNING
+        only matches the row when user_id owns it, every condition in
+        where holds and, if version is given, nobody has updated it since
+        returning adds expressions to the columns of the row
+        returns the updated row or None when nothing matched
+        caches built from the row are refreshed through cls.changed
+        """
+        table = cls.__table__
+        condition = db.and_(
+            table.c.id == row_id, table.c.user_id == user_id, *where)
+        if version is not None:
+            condition = db.and_(condition, table.c.version == version)
+        row = db.session.execute(
+            table.update().where(condition).values(
+                version=table.c.version + 1, **values
+            ).returning(*(list(table.c) + list(returning)))
+        ).fetchone()
+        db.session.commit()
+        if row is not None:
+            cls.changed(row)
+        return row
+
+
+class Business(Versioned, db.Model):
     """Create table businesses
     One-to-Many relationship with review and user
     business belongs to user
     business has many reviews
+    search_vector is kept up to date by a trigger from name, category
+    and bio, see migration e7a3c5f92d18
+    lower(name) has a pg_trgm GIN index for substring and fuzzy
+    matching, see migration 8a9d4e2b71c3
     """
     __tablename__ = 'businesses'
+    __table_args__ = (
+        db.Index('ix_businesses_created_at_id', 'created_at', 'id'),
+        db.Index(
+            'ix_businesses_search_vector', 'search_vector',
+            postgresql_using='gin'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(), index=True)
+    name = db.Column(db.String(), index=True, unique=True)
     logo = db.Column(db.String())
     location = db.Column(db.String(), index=True)
     category = db.Column(db.String(), index=True)
     bio = db.Column(db.String())
+    search_vector = db.deferred(db.Column(TSVECTOR))
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     updated_at = db.Column(
@@ -89,71 +140,159 @@ class Business(db.Model):
     )
 
     def __init__(self, name=None, logo=None, location=None,
-                 category=None, bio=None, owner=None):
+                 category=None, bio=None, owner=None, user_id=None):
+        """owner may be given as an instance or by user_id alone"""
         self.name = name
         self.logo = logo
         self.location = location
         self.category = category
         self.bio = bio
-        self.owner = owner
-
-    def Search(self, params):
-        """Search and filter"""
-        page = params['page']
+        if owner is not None:
+            self.owner = owner
+        else:
+            self.user_id = user_id
+
+    # filters applied when their parameter is present, composed in order
+    search_filters = [
+        ('location', lambda value: Business.location == value),
+        ('category', lambda value: Business.category == value)
+    ]
+
+    # how q matches, chosen by ?match=
+    # each mode is the condition and the rank ordering results, highest
+    # first; unranked modes keep the newest first order
+    match_modes = {
+        'text': (
+            lambda value: Business.search_vector.op('@@')(
+                Business.text_query(value)),
+            lambda value: db.func.ts_rank_cd(
+                Business.search_vector, Business.text_query(value))
+        ),
+        'substring': (
+            lambda value: db.func.lower(Business.name).like(
+                '%{}%'.format(Business.escape_like(value.lower())),
+                escape='\\'),
+            None
+        ),
+        'fuzzy': (
+            # pg_trgm's % operator, which the trigram index serves, written
+            # %% since sqlalchemy leaves it for psycopg2's format style
+            lambda value: db.func.lower(Business.name).op('%%')(
+                value.lower()),
+            lambda value: db.func.similarity(
+                db.func.lower(Business.name), value.lower())
+        )
+    }
+
+    @staticmethod
+    def text_query(value):
+        """tsquery for free text typed by a user"""
+        return db.func.plainto_tsquery('english', value)
+
+    @staticmethod
+    def escape_like(value):
+        """value with LIKE wildcards taken literally"""
+        for char in '\\%_':
+            value = value.replace(char, '\\' + char)
+        return value
+
+    def filtered(self, params):
+        """Query with every search filter present in params applied"""
+        query = self.query
+        for param, condition in self.search_filters:
+            if params.get(param):
+                query = query.filter(condition(params[param]))
+        if params.get('_query'):
+            mode = params.get('match', 'text')
+            if mode == 'fuzzy':
+                # the % operator compares against this setting,
+                # local to the transaction
+                db.session.execute(
+                    db.text("SELECT set_config("
+                            "'pg_trgm.similarity_threshold', :threshold, "
+                            "true)"),
+                    {'threshold': str(
+                        app.config['TRIGRAM_SIMILARITY_THRESHOLD'])})
+            condition = self.match_modes[mode][0]
+            query = query.filter(condition(params['_query']))
+        return query
+
+    def Search(self, params, load=()):
+        """Search and filter
+        newest first, paged by the (created_at, id) keyset when a cursor
+        is given or by page number otherwise
+        ranked matches on q are ordered by relevance instead and paged
+        by offset
+        one extra row is fetched to tell if there is a next page, so no
+        count query is run
+        load holds loader options for the relationships the caller reads
+        returns the page and the cursor of the next one, None on the last
+        """
         limit = params['limit']
-        location = params['location']
-        category = params['category']
-        _query = params['_query']
-
-        if _query or location or category:
-            if location and _query and not category:
-                return self.query.filter(
-                    Business.location == location,
-                    Business.name.ilike('%' + _query + '%')
-                ).paginate(page, limit, error_out=False).items
-
-            if category and _query and not location:
-                return self.query.filter(
-                    Business.category == category,
-                    Business.name.ilike('%' + _query + '%')
-                ).paginate(page, limit, error_out=False).items
-
-            if category and location and not _query:
-                return self.query.filter(
-                    Business.location == location,
-                    Business.category == category
-                ).paginate(page, limit, error_out=False).items
-
-            if location and not _query and not category:
-                return self.query.filter(
-                    Business.location == location
-                ).paginate(page, limit, error_out=False).items
-
-            if category and not _query and not location:
-                return self.query.filter(
-                    Business.category == category
-                ).paginate(page, limit, error_out=False).items
-
-            return self.query.filter(
-                Business.name.ilike('%' + _query + '%')
-            ).paginate(page, limit, error_out=False).items
-
-        return self.query.order_by(
-            Business.created_at.desc()
-        ).paginate(page, limit, error_out=False).items
+        query = self.filtered(params).options(*load)
+
+        rank = None
+        if params.get('_query'):
+            rank = self.match_modes[params.get('match', 'text')][1]
+
+        if rank is not None:
+            rank = rank(params['_query'])
+            offset = offset_value(params['cursor']) if params.get('cursor') \
+                else (params['page'] - 1) * limit
+            businesses = query.order_by(
+                rank.desc(), Business.id.desc()
+            ).offset(offset).limit(limit + 1).all()
+            if len(businesses) > limit:
+                return businesses[:limit], encode_cursor({'o': offset + limit})
+            return businesses, None
+
+        query = query.order_by(Business.created_at.desc(), Business.id.desc())
+        if params.get('cursor'):
+            created_at, business_id = keyset_values(params['cursor'])
+            query = query.filter(
+                db.tuple_(Business.created_at, Business.id) <
+                db.tuple_(created_at, business_id)
+            )
+        else:
+            query = query.offset((params['page'] - 1) * limit)
+
+        businesses = query.limit(limit + 1).all()
+        if len(businesses) > limit:
+            last = businesses[limit - 1]
+            return businesses[:limit], keyset_cursor(last.created_at, last.id)
+        return businesses, None
+
+    def total(self, params, mode):
+        """Number of businesses matching params
+        mode 'exact' counts, 'estimate' asks the query planner
+        """
+        query = self.filtered(params)
+        if mode == 'estimate':
+            return estimated_count(query)
+        return query.count()
+
+    @staticmethod
+    def changed(business):
+        """Refresh what is cached of a saved or updated business"""
+        business_names.upsert(business.id, business.name)
+        response_cache.invalidate(business_tag(business.id))
 
     def save(self):
         """Save a business to the database"""
         db.session.add(self)
         db.session.commit()
+        self.changed(self)
 
     def delete(self):
         """Delete a given business"""
+        business_id = self.id
         db.session.delete(self)
         db.session.commit()
+        business_names.discard(business_id)
+        response_cache.invalidate(business_tag(business_id))
 
 
-class Review(db.Model):
+class Review(Versioned, db.Model):
     """Create table reviews
     One-to-Many relationship with user and business
     review belongs to business
@@ -177,26 +316,71 @@ class Review(db.Model):
         nullable=False
     )
 
-    def __init__(self, title, desc, business, reviewer):
+    def __init__(self, title, desc, business=None, reviewer=None,
+                 business_id=None, user_id=None):
+        """business and reviewer may be given as instances or by id"""
         self.title = title
         self.desc = desc
-        self.business = business
-        self.reviewer = reviewer
+        if business is not None:
+            self.business = business
+        else:
+            self.business_id = business_id
+        if reviewer is not None:
+            self.reviewer = reviewer
+        else:
+            self.user_id = user_id
+
+    @staticmethod
+    def changed(review):
+        """Drop cached reads of the business of a saved or updated review"""
+        response_cache.invalidate(business_tag(review.business_id))
 
     def save(self):
         """Save a review to the database"""
         db.session.add(self)
         db.session.commit()
+        self.changed(self)
 
     def delete(self):
         """Delete a given review."""
+        business_id = self.business_id
         db.session.delete(self)
         db.session.commit()
+        response_cache.invalidate(business_tag(business_id))
 
 
 class Notification(db.Model):
-    """Handles notifications when user reviews on a business"""
+    """Handles notifications when user reviews on a business
+    the inbox is paged newest first by (created_at, id)
+    with NOTIFICATION_COALESCE_WINDOW set, reviews of one business within
+    a window fold into a single unread notification found by its
+    coalesce_key and window_start, counting its actors and keeping the
+    latest few
+    the table is range partitioned by window_start, one partition a month,
+    see versions/partitions.py, so window_start is part of every unique
+    key. It is created_at unless the notification is coalesced, created_at
+    always keeps when the first review came in and never moves
+    event_id is new on every insert and every fold, event streams send it
+    and replay what a client missed by it
+    """
     __tablename__ = 'notifications'
+    REVIEWED = ' reviewed one of your businesses'
+    __table_args__ = (
+        db.Index(
+            'ix_notifications_recipient_id_created_at_id',
+            'recipient_id', 'created_at', 'id'),
+        db.Index(
+            'ix_notifications_unread_recipient_id_created_at_id',
+            'recipient_id', 'created_at', 'id',
+            postgresql_where=db.text('read_at IS NULL')),
+        db.Index(
+            'ix_notifications_recipient_id_event_id',
+            'recipient_id', 'event_id'),
+        db.Index(
+            'ux_notifications_recipient_id_coalesce_key_window_start',
+            'recipient_id', 'coalesce_key', 'window_start', unique=True,
+            postgresql_where=db.text('read_at IS NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     recipient_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -205,35 +389,269 @@ class Notification(db.Model):
     review_id = db.Column(db.Integer, nullable=False)
     action = db.Column(db.String(), nullable=False)
     read_at = db.Column(db.DateTime)
-    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
-
-    def __init__(self, recipient, actor, business_id, review_id, read_at=None):
-        self.recipient = recipient
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=db.func.current_timestamp())
+    window_start = db.Column(
+        db.DateTime, primary_key=True, default=db.func.current_timestamp())
+    actor_count = db.Column(
+        db.Integer, nullable=False, default=1, server_default='1')
+    # latest actors first, only kept on coalesced notifications
+    actors = db.Column(ARRAY(db.String()))
+    coalesce_key = db.Column(db.String())
+    event_id = db.Column(
+        db.BigInteger, nullable=False,
+        server_default=db.text("nextval('notification_events_seq')"))
+
+    def __init__(self, recipient=None, actor=None, business_id=None,
+                 review_id=None, read_at=None, recipient_id=None):
+        if recipient is not None:
+            self.recipient = recipient
+        else:
+            self.recipient_id = recipient_id
         self.actor = actor
         self.business_id = business_id
         self.review_id = review_id
         self.read_at = read_at
-        self.action = ' reviewed one of your businesses'
+        self.action = self.REVIEWED
 
     def save(self):
         """Save a review to the database"""
         db.session.add(self)
         db.session.commit()
 
-class AuthToken(db.Model):
-    """Stores all tokens during login"""
+    @classmethod
+    def reviewed(cls, recipient_id, actor, business_id, review_id):
+        """Notify recipient_id of a review in one statement
+        returns the row with `inserted`, False when the review was folded
+        into an unread notification of the same business and window
+        """
+        table = cls.__table__
+        values = {
+            'recipient_id': recipient_id,
+            'actor': actor,
+            'business_id': business_id,
+            'review_id': review_id,
+            'action': cls.REVIEWED
+        }
+        window = app.config['NOTIFICATION_COALESCE_WINDOW']
+        if not window:
+            return db.session.execute(table.insert().values(values).returning(
+                *(list(table.c) + [db.true().label('inserted')])
+            )).first()
+
+        values['actors'] = [actor]
+        values['coalesce_key'] = 'business:{}'.format(business_id)
+        # the window it falls in, created_at stays the time of the review
+        values['window_start'] = db.func.to_timestamp(db.func.floor(
+            db.extract('epoch', db.func.current_timestamp()) / window
+        ) * window)
+        statement = insert(table).values(values)
+        return db.session.execute(statement.on_conflict_do_update(
+            index_elements=[
+                table.c.recipient_id, table.c.coalesce_key,
+                table.c.window_start],
+            index_where=table.c.read_at == None,
+            set_={
+                'actor': statement.excluded.actor,
+                'review_id': statement.excluded.review_id,
+                'actor_count': table.c.actor_count + 1,
+                'event_id': db.func.nextval('notification_events_seq'),
+                'actors': db.literal_column(
+                    '(array_prepend(excluded.actor, notifications.actors))'
+                    '[1:{:d}]'.format(app.config['NOTIFICATION_ACTORS_KEPT']))
+            }
+        ).returning(
+            # a fold always raises the count, only an insert leaves it at 1
+            # (xmax cannot be read back from a partitioned table)
+            *(list(table.c) + [(table.c.actor_count == 1).label('inserted')])
+        )).first()
+
+
+class NotificationCounter(db.Model):
+    """Unread notifications of a user, kept so the badge never counts
+    incremented with every notification created, decremented as they
+    are marked read, both in the same transaction as the change
+    """
+    __tablename__ = 'notification_counters'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+    unread = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
+    @classmethod
+    def increment(cls, user_id, by=1):
+        """Add to the count of user_id, creating its row if needed"""
+        statement = insert(cls.__table__).values(user_id=user_id, unread=by)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[cls.__table__.c.user_id],
+            set_={'unread': cls.__table__.c.unread + by}
+        ))
+
+    @classmethod
+    def decrement(cls, user_id, by):
+        """Take from the count of user_id, never below zero
+        returns what is left
+        """
+        table = cls.__table__
+        left = db.session.execute(
+            table.update().where(table.c.user_id == user_id).values(
+                unread=db.case([(table.c.unread > by, table.c.unread - by)],
+                               else_=0)
+            ).returning(table.c.unread)
+        ).scalar()
+        return left or 0
+
+    @classmethod
+    def unread_for(cls, user_id):
+        """Current count of user_id"""
+        return db.session.query(cls.unread).filter(
+            cls.user_id == user_id).scalar() or 0
+
+class CacheTag(db.Model):
+    """Version of a response cache tag, bumped on every write it covers
+    read by every worker with RESPONSE_CACHE_STORAGE=postgres, see
+    versions/responsecache.py
+    """
+    __tablename__ = 'cache_tags'
+
+    tag = db.Column(db.String(), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=1)
+
+
+class Outbox(db.Model):
+    """Emails waiting for delivery
+    rows are written in the same transaction as the change that causes
+    them and drained in batches by the outbox worker
+    status moves from pending to sent, or to dead after too many failures
+    """
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        db.Index('ix_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    subject = db.Column(db.String(), nullable=False)
+    recipients = db.Column(db.String(), nullable=False)
+    template = db.Column(db.String(), nullable=False)
+    context = db.Column(db.Text())
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String())
+    # utc, the clock drain compares it with
+    next_attempt_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    sent_at = db.Column(db.DateTime)
+
+    def __init__(self, subject, recipients, template, context):
+        self.subject = subject
+        self.recipients = ','.join(recipients)
+        self.template = template
+        self.context = context
+        self.status = 'pending'
+        self.attempts = 0
+
+
+class ExpiringToken(object):
+    """Shared purge for token tables with an expires_at column"""
+
+    @classmethod
+    def purge_expired(cls, batch_size=1000):
+        """Delete expired tokens one short transaction per batch
+        returns number of rows deleted
+        """
+        total = 0
+        while True:
+            expired = db.session.query(cls.id).filter(
+                cls.expires_at < datetime.datetime.utcnow()
+            ).limit(batch_size).subquery()
+            deleted = cls.query.filter(cls.id.in_(expired)).delete(
+                synchronize_session=False)
+            db.session.commit()
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+
+class AuthToken(ExpiringToken, db.Model):
+    """Stores a digest of every token issued during login
+    expires_at mirrors the token `exp` so expired rows can be purged
+    """
     __tablename__ = 'authtokens'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    token = db.Column(db.String(), nullable=False)
+    digest = db.Column(db.String(64), unique=True, index=True, nullable=False)
+    expires_at = db.Column(db.DateTime, index=True, nullable=False)
     valid = db.Column(db.Boolean, nullable=False)
 
-    def __init__(self, token, valid=True):
-        self.token = token
+    def __init__(self, token, expires_at, valid=True):
+        self.digest = token_digest(token)
+        self.expires_at = expires_at
         self.valid = valid
 
+    @classmethod
+    def find(cls, token):
+        """Fetch the row of a raw token through the digest index"""
+        return cls.query.filter_by(digest=token_digest(token)).first()
+
     def save(self):
-        """Save a review to the database"""
+        """Save a token to the database"""
         db.session.add(self)
         db.session.commit()
-    
\ No newline at end of file
+
+
+class RefreshToken(ExpiringToken, db.Model):
+    """Long lived tokens exchanged for new access tokens
+    only a digest is kept, every token belongs to the family started at
+    login and is replaced by a successor each time it is used
+    """
+    __tablename__ = 'refreshtokens'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    digest = db.Column(db.String(64), unique=True, index=True, nullable=False)
+    family = db.Column(db.String(32), index=True, nullable=False)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False
+    )
+    expires_at = db.Column(db.DateTime, index=True, nullable=False)
+    used = db.Column(db.Boolean, nullable=False, default=False)
+    revoked = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __init__(self, token, family, user_id, expires_at):
+        self.digest = token_digest(token)
+        self.family = family
+        self.user_id = user_id
+        self.expires_at = expires_at
+        self.used = False
+        self.revoked = False
+
+    @staticmethod
+    def generate():
+        """Random opaque refresh token"""
+        return binascii.hexlify(os.urandom(32)).decode('ascii')
+
+    @classmethod
+    def find(cls, token):
+        """Fetch the row of a raw token through the digest index"""
+        return cls.query.filter_by(digest=token_digest(token)).first()
+
+    @classmethod
+    def claim(cls, token_id):
+        """Mark a token used, False when it was used or revoked already
+        conditional so two concurrent refreshes cannot both succeed
+        """
+        return cls.query.filter_by(
+            id=token_id, used=False, revoked=False
+        ).update({'used': True}, synchronize_session=False) == 1
+
+    @classmethod
+    def revoke_family(cls, family):
+        """Revoke every token descended from one login"""
+        cls.query.filter_by(family=family, revoked=False).update(
+            {'revoked': True}, synchronize_session=False)
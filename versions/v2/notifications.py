@@ -1,67 +1,229 @@
-from flask import Blueprint, jsonify
-from versions.v2.models import db, Notification, User
-from versions import login_required
+import queue
+from flask import Blueprint, Response, json, jsonify, request
+from flask import stream_with_context
+from versions.v2.models import db, Notification, NotificationCounter
+from versions import app, login_required, notification_broker
+from versions.pagination import clamp_limit, decode_cursor, keyset_cursor
+from versions.pagination import keyset_values
 
 mod = Blueprint('notification_v2', __name__)
 
 
+def serialize(notification, username):
+    """Notification row as sent to its recipient username
+    actor and review_id are the latest of a coalesced notification
+    """
+    others = notification['actor_count'] - 1
+    return {
+        'id': notification['id'],
+        'recipient_id': username,
+        'actor': notification['actor'],
+        'actor_count': notification['actor_count'],
+        'actors': notification['actors'] or [notification['actor']],
+        'business_id': notification['business_id'],
+        'review_id': notification['review_id'],
+        'action': notification['action'],
+        'created_at': notification['created_at'],
+        'read_at': notification['read_at'],
+        'act': notification['actor'] + (
+            ' and {} other{}'.format(others, 's' if others > 1 else '')
+            if others else '') + notification['action'],
+        'url': '/business/{}#review-{}'.format(notification['business_id'], notification['review_id'])
+    }
+
+
+def notification_event(notification, username):
+    """Broker event of a notification row, ready for an event stream
+    keyed by event_id so a fold of a notification already sent is sent again
+    """
+    return {
+        'id': notification['event_id'],
+        'data': json.dumps(serialize(notification, username))
+    }
+
+
+def stream_notifications(rows, username, **fields):
+    """Streams rows as {"notifications": [...]} one row at a time
+    fields are added next to the list
+    """
+    def generate():
+        yield '{"notifications": ['
+        for index, notification in enumerate(rows):
+            yield (', ' if index else '') + json.dumps(
+                serialize(notification, username))
+        yield ']'
+        for name, value in sorted(fields.items()):
+            yield ', {}: {}'.format(json.dumps(name), json.dumps(value))
+        yield '}'
+    return Response(
+        stream_with_context(generate()), mimetype='application/json')
+
+
+def newest_first(table):
+    """Inbox order, served by the (recipient_id, created_at, id) index"""
+    return table.c.created_at.desc(), table.c.id.desc()
+
+
 @mod.route('', methods=['GET'])
 @login_required
 def get_notifications(current_user):
-    """Fetch all unread notifications of current user"""
-    unread = db.session.query(Notification).join(User).filter(
-        User.id==current_user,
-        Notification.read_at==None
-    ).all()
-
-    if unread:
-        for notification in unread:
-            notification.read_at = db.func.current_timestamp()
-            notification.save()
-
-        return jsonify({'notifications': [
-                {
-                    'id': notification.id,
-                    'recipient_id': notification.recipient.username,
-                    'actor': notification.actor,
-                    'business_id': notification.business_id,
-                    'review_id': notification.review_id,
-                    'action': notification.action,
-                    'created_at': notification.created_at,
-                    'read_at': notification.read_at,
-                    'act': notification.actor + notification.action,
-                    'url': '/business/{}#review-{}'.format(notification.business_id, notification.review_id)
-                } for notification in unread
-            ]}), 200
-
-    return jsonify({'warning': 'user has no notifications'}), 200
+    """Fetch unread notifications of current user, newest first
+    one UPDATE ... RETURNING marks a page of at most limit read and
+    returns it, calling again fetches the next page
+    `unread` is how many are left, from the counter
+    """
+    limit = clamp_limit(request.args.get('limit', default=20, type=int))
+    table = Notification.__table__
+    unread = table.c.read_at == None
+    page = db.select([table.c.id]).where(db.and_(
+        table.c.recipient_id == current_user.id, unread
+    )).order_by(*newest_first(table)).limit(limit)
+
+    # read_at is checked again so a concurrent request cannot mark and
+    # count the same rows
+    marked = db.session.execute(
+        table.update().where(db.and_(table.c.id.in_(page), unread)).values(
+            read_at=db.func.current_timestamp()
+        ).returning(*table.c)
+    ).fetchall()
+    if not marked:
+        db.session.rollback()
+        return jsonify({'warning': 'user has no notifications'}), 200
+
+    left = NotificationCounter.decrement(current_user.id, len(marked))
+    db.session.commit()
+
+    marked.sort(key=lambda row: (row.created_at, row.id), reverse=True)
+    return stream_notifications(
+        marked, current_user.username, unread=left), 200
+
 
 @mod.route('/all', methods=['GET'])
 @login_required
 def get_all_notifications(current_user):
-    """Fetch all unread notifications of current user"""
-    all_notifications = db.session.query(Notification).join(User).filter(
-        User.id==current_user
-    ).all()
-
-    if all_notifications:
-        for notification in all_notifications:
-            notification.read_at = db.func.current_timestamp()
-            notification.save()
-
-        return jsonify({'notifications': [
-                {
-                    'id': notification.id,
-                    'recipient_id': notification.recipient.username,
-                    'actor': notification.actor,
-                    'business_id': notification.business_id,
-                    'review_id': notification.review_id,
-                    'action': notification.action,
-                    'created_at': notification.created_at,
-                    'read_at': notification.read_at,
-                    'act': notification.actor + notification.action,
-                    'url': '/business/{}#review-{}'.format(notification.business_id, notification.review_id)
-                } for notification in all_notifications
-            ]}), 200
+    """Fetch notifications of current user newest first, paged by the
+    (created_at, id) keyset, marking unread ones of the page read
+    `next` is the cursor of the following page
+    """
+    limit = clamp_limit(request.args.get('limit', default=20, type=int))
+    cursor = request.args.get('cursor', default=None, type=str)
+    table = Notification.__table__
+    query = db.select(table.c).where(
+        table.c.recipient_id == current_user.id)
+    if cursor:
+        created_at, notification_id = keyset_values(decode_cursor(cursor))
+        query = query.where(
+            db.tuple_(table.c.created_at, table.c.id) <
+            db.tuple_(created_at, notification_id))
+
+    rows = [dict(row) for row in db.session.execute(
+        query.order_by(*newest_first(table)).limit(limit + 1))]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = keyset_cursor(rows[-1]['created_at'], rows[-1]['id'])
+
+    unread_ids = [row['id'] for row in rows if row['read_at'] is None]
+    if unread_ids:
+        marked = dict(db.session.execute(
+            table.update().where(db.and_(
+                table.c.id.in_(unread_ids), table.c.read_at == None
+            )).values(
+                read_at=db.func.current_timestamp()
+            ).returning(table.c.id, table.c.read_at)
+        ).fetchall())
+        NotificationCounter.decrement(current_user.id, len(marked))
+        for row in rows:
+            row['read_at'] = marked.get(row['id'], row['read_at'])
+    db.session.commit()
+
+    if rows:
+        return stream_notifications(
+            rows, current_user.username, next=next_cursor), 200
 
     return jsonify({'warning': 'No New Notifications'}), 200
+
+
+@mod.route('/unread-count', methods=['GET'])
+@login_required
+def get_unread_count(current_user):
+    """Number of unread notifications of current user, for the badge
+    read from the per user counter, the notifications are not scanned
+    """
+    return jsonify({
+        'unread': NotificationCounter.unread_for(current_user.id)
+    }), 200
+
+
+@mod.route('/stream', methods=['GET'])
+@login_required
+def stream(current_user):
+    """Server-sent events, one `notification` event per review of a
+    business of current user as it is created
+    a reconnect sending Last-Event-ID (or ?last_event_id=) first gets the
+    notifications created or folded into since that event
+    the stream holds no database connection while it waits, it does hold
+    a worker thread so a worker serves at most SSE_MAX_STREAMS and none
+    on a worker without threads
+    """
+    last_event_id = request.headers.get(
+        'Last-Event-ID', request.args.get('last_event_id'))
+    if last_event_id is not None and not last_event_id.isdigit():
+        return jsonify({'warning': 'Last-Event-ID should be a number'}), 400
+
+    # subscribed before the backlog is read so nothing falls in between
+    limit = app.config['SSE_MAX_STREAMS']
+    if not request.environ.get('wsgi.multithread'):
+        limit = 0
+    events = notification_broker.subscribe(current_user.id, limit)
+    if events is None:
+        response = jsonify({
+            'warning': 'Too many open streams, try again later'})
+        response.headers['Retry-After'] = str(app.config['SSE_RETRY'] // 1000)
+        return response, 503
+    backlog = []
+    if last_event_id is not None:
+        table = Notification.__table__
+        backlog = [
+            notification_event(row, current_user.username)
+            for row in db.session.execute(
+                db.select(table.c).where(db.and_(
+                    table.c.recipient_id == current_user.id,
+                    table.c.event_id > int(last_event_id)
+                )).order_by(table.c.event_id).limit(
+                    app.config['SSE_BACKLOG_LIMIT']))
+        ]
+    db.session.close()
+
+    heartbeat = app.config['SSE_HEARTBEAT']
+    retry = app.config['SSE_RETRY']
+
+    def generate():
+        replayed = set(event['id'] for event in backlog)
+        yield 'retry: {}\n\n'.format(retry)
+        for event in backlog:
+            yield 'id: {}\nevent: notification\ndata: {}\n\n'.format(
+                event['id'], event['data'])
+        while True:
+            try:
+                event = events.get(timeout=heartbeat)
+            except queue.Empty:
+                # keeps proxies from closing an idle stream
+                yield ': keepalive\n\n'
+                continue
+            if event['id'] in replayed:
+                continue
+            yield 'id: {}\nevent: notification\ndata: {}\n\n'.format(
+                event['id'], event['data'])
+
+    # not stream_with_context, the request and its session end as soon as
+    # the response starts
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # on close rather than in the generator, which never runs its finally
+    # when the client leaves before the first chunk
+    response.call_on_close(
+        lambda: notification_broker.unsubscribe(current_user.id, events))
+    return response
@@ -9,9 +9,15 @@ DELETE: Deletes a Review
     expects businessID, current_user and reviewID as arguments
 """
 from flask import Blueprint, jsonify, request
-from versions.v2.models import Business, db, User, Review, Notification
-from versions import login_required
+from versions.v2.models import Business, db, Review, Notification
+from versions.v2.models import NotificationCounter
+from versions import login_required, notification_broker, response_cache
+from versions.responsecache import business_tag
+from versions.v2.notifications import notification_event
 from functools import wraps
+from versions.conditional import conditional, is_fresh
+from versions.conditional import make_etag, not_modified, validate
+from versions.conditional import if_match_version, version_etag
 
 mod = Blueprint('review_v2', __name__)
 
@@ -22,20 +28,24 @@ def precheck(f):
     """
     @wraps(f)
     def wrap(*args, **kwargs):
-        business = Business.query.get(kwargs['businessId'])
-        review = Review.query.get(kwargs['reviewId'])
+        return refusal(args[0], kwargs['businessId'], kwargs['reviewId']) \
+            or f(*args, **kwargs)
+    return wrap
+
 
-        if not business:
-            return jsonify({'warning': 'Business Not Found'}), 404
+def refusal(current_user, businessId, reviewId):
+    """Response when current_user may not change the review, else None"""
+    business = Business.query.get(businessId)
+    review = Review.query.get(reviewId)
 
-        if not review:
-            return jsonify({'warning': 'Review Not Found'}), 404
+    if not business:
+        return jsonify({'warning': 'Business Not Found'}), 404
 
-        if args[0] != review.reviewer.id:
-            return jsonify({'warning': 'Not Allowed, you are not owner'}), 401
+    if not review or review.business_id != business.id:
+        return jsonify({'warning': 'Review Not Found'}), 404
 
-        return f(*args, **kwargs)
-    return wrap
+    if current_user.id != review.user_id:
+        return jsonify({'warning': 'Not Allowed, you are not owner'}), 401
 
 
 @mod.route('/<businessId>/reviews', methods=['POST'])
@@ -45,18 +55,22 @@ def create_review(current_user, businessId):
     Takes current user ID and business ID then attachs it to response data
     """
     data = request.get_json()
-    _reviewer = User.query.get(current_user)
-    _business = Business.query.get(businessId)
+    _business = Business.query.options(
+        db.joinedload(Business.owner)).get(businessId)
 
     if not _business:
         return jsonify({'warning': 'Business Not Found'}), 404
 
+    # read before save, commit expires the instance
+    owner_id = _business.user_id
+    owner_username = _business.owner.username
+
     # create new review instances
     new_review = Review(
         title=data['title'],
         desc=data['desc'],
-        business=_business,
-        reviewer=_reviewer
+        business_id=_business.id,
+        user_id=current_user.id
     )
 
     # Commit changes to db
@@ -64,22 +78,24 @@ def create_review(current_user, businessId):
 
     # Send response if business was saved
     if new_review.id:
-        # create a notification if review is created
-        if current_user != _business.owner.id:
-            new_notification = Notification(
-                recipient=_business.owner,
-                actor=_reviewer.username,
-                business_id=businessId,
-                review_id=new_review.id
-            )
-            new_notification.save()
+        # create a notification if review is created, counted as unread
+        # in the same transaction unless it was folded into one already
+        # counted, pushed to open streams once committed
+        if current_user.id != owner_id:
+            notification = Notification.reviewed(
+                owner_id, current_user.username, _business.id, new_review.id)
+            if notification.inserted:
+                NotificationCounter.increment(owner_id)
+            db.session.commit()
+            notification_broker.publish(
+                owner_id, notification_event(notification, owner_username))
 
         return jsonify({
             'success': 'successfully created review',
             'review': {
                 'id': new_review.id,
                 'title': new_review.title,
-                'reviewer': new_review.reviewer.username,
+                'reviewer': current_user.username,
                 'desc': new_review.desc
             }
         }), 201
@@ -88,24 +104,44 @@ def create_review(current_user, businessId):
 
 
 @mod.route('/<businessId>/reviews', methods=['GET'])
+@conditional
+@response_cache.cached(
+    lambda businessId: [business_tag(businessId)])
 def read_review(businessId):
-    """Reads all Review given a business ID"""
+    """Reads all Review given a business ID
+    validators come from a probe of the reviews, a client holding the
+    current version gets a 304 before they are fetched
+    """
     business = Business.query.get(businessId)
     if not business:
         return jsonify({'warning': 'Business Not Found'}), 404
 
-    if business.reviews:
-        return jsonify({'reviews': [
+    updated_at, count = db.session.query(
+        db.func.max(Review.updated_at), db.func.count(Review.id)
+    ).filter(Review.business_id == business.id).one()
+    etag = make_etag(
+        'reviews', business.id, business.updated_at, updated_at, count)
+    if is_fresh(etag, None):
+        return not_modified(etag, None)
+
+    reviews = Review.query.options(
+        db.joinedload(Review.reviewer)
+    ).filter_by(business_id=business.id).all()
+
+    if reviews:
+        response = jsonify({'reviews': [
             {
                 'id': review.id,
                 'title': review.title,
                 'desc': review.desc,
                 'reviewer': review.reviewer.username,
-                'business': review.business.name,
+                'business': business.name,
+                'version': review.version,
                 'created_at': review.created_at,
                 'updated_at': review.updated_at,
-            } for review in business.reviews
-        ]}), 200
+            } for review in reviews
+        ]})
+        return validate(response, etag, None)
 
     return jsonify({'warning': 'Business has no reviews'}), 200
 
@@ -135,7 +171,10 @@ def delete_review(current_user, businessId, reviewId):
 @login_required
 def read_all_reviews(current_user):
     """Reads all Reviews"""
-    reviews = Review.query.all()
+    reviews = Review.query.options(
+        db.joinedload(Review.reviewer),
+        db.joinedload(Review.business)
+    ).all()
     if reviews:
         return jsonify({'Reviews': [
             {
@@ -154,31 +193,40 @@ def read_all_reviews(current_user):
 
 @mod.route('/<businessId>/reviews/<reviewId>', methods=['PUT'])
 @login_required
-@precheck
 def update_business(current_user, businessId, reviewId):
     """Updates a review given a business ID
-    confirms if current user is owner of business
+    one conditional UPDATE confirms the review belongs to the business,
+    current user is owner of the review and, when If-Match is sent, that
+    nobody changed it since it was read
+    the rows are only loaded to explain a refused update
     """
     data = request.get_json()
-    review = Review.query.get(reviewId)
-
-    review.title = data['title']
-    review.desc = data['desc']
-
-    review.save()
-
-    if review.title == data['title']:
-        return jsonify({
-            'success': 'successfully updated',
-            'review': {
-                'id': review.id,
-                'title': review.title,
-                'desc': review.desc,
-                'reviewer': review.reviewer.username,
-                'business': review.business.name,
-                'created_at': review.created_at,
-                'updated_at': review.updated_at
-            }
-        }), 201
-
-    return jsonify({'warning': 'Review Not Updated'}), 400
+    business_name = db.select([Business.name]).where(
+        Business.id == Review.business_id).as_scalar().label('business')
+
+    review = Review.update_owned(
+        reviewId, current_user.id,
+        {'title': data['title'], 'desc': data['desc']},
+        if_match_version('review', reviewId),
+        returning=[business_name],
+        where=[Review.business_id == businessId])
+
+    if review is None:
+        return refusal(current_user, businessId, reviewId) or (
+            jsonify({'warning': 'Review was changed, reload it'}), 412)
+
+    response = jsonify({
+        'success': 'successfully updated',
+        'review': {
+            'id': review.id,
+            'title': review.title,
+            'desc': review.desc,
+            'reviewer': current_user.username,
+            'business': review.business,
+            'version': review.version,
+            'created_at': review.created_at,
+            'updated_at': review.updated_at
+        }
+    })
+    response.set_etag(version_etag('review', review.id, review.version))
+    return response, 201
@@ -5,7 +5,9 @@ get all reviews that belongs to a user
 get one user information
 """
 from flask import Blueprint, jsonify
-from versions.v2.models import User
+from versions.conditional import conditional, is_fresh, make_etag
+from versions.conditional import not_modified, validate
+from versions.v2.models import Business, db, User
 
 
 mod = Blueprint('users_v2', __name__)
@@ -14,7 +16,7 @@ mod = Blueprint('users_v2', __name__)
 @mod.route('', methods=['GET'])
 def get_all_users():
     """Read all users"""
-    users = User.query.all()
+    users = User.query.options(db.selectinload(User.businesses)).all()
     if users:
         return jsonify(
             [
@@ -34,27 +36,43 @@ def get_all_users():
 
 
 @mod.route('/<user_id>', methods=['GET'])
+@conditional
 def read_user(user_id):
     """Reads user given an ID"""
     user = User.query.get(user_id)
     if user:
-        return jsonify({'user': {
+        response = jsonify({'user': {
             'username': user.username,
             'fullname': user.fullname,
             'id': user.id,
             'activate': user.activate,
             'email': user.email
-        }}), 200
+        }})
+        # the email makes it personal, shared caches must not keep it
+        return validate(
+            response, make_etag('user', user.id, user.updated_at),
+            user.updated_at, private=True)
 
     return jsonify({'warning': 'user does not exist'}), 404
 
 
 @mod.route('/<user_id>/businesses', methods=['GET'])
+@conditional
 def read_user_businesses(user_id):
-    """Read all businesses owned by this user"""
+    """Read all businesses owned by this user
+    validators come from a probe of the businesses, a client holding the
+    current version gets a 304 before they are fetched
+    """
     user = User.query.get(user_id)
     if user:
-        return jsonify(
+        updated_at, count = db.session.query(
+            db.func.max(Business.updated_at), db.func.count(Business.id)
+        ).filter(Business.user_id == user.id).one()
+        etag = make_etag('businesses', user.id, updated_at, count)
+        if is_fresh(etag, None):
+            return not_modified(etag, None)
+
+        response = jsonify(
             [
                 {
                     'id': business.id,
@@ -67,6 +85,7 @@ def read_user_businesses(user_id):
                     'updated_at': business.updated_at
                 } for business in user.businesses
             ] if user.businesses else None
-        ), 200
+        )
+        return validate(response, etag, None)
 
     return jsonify({'warning': 'user does not own a business'}), 200